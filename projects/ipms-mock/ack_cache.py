@@ -0,0 +1,92 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import Counter, registry
+
+ACK_CACHE_SIZE = int(os.getenv('ACK_CACHE_SIZE', '10000'))  # Control IDs whose ACK is remembered, 0 disables the cache
+ACK_CACHE_TTL = float(os.getenv('ACK_CACHE_TTL', '300'))  # Seconds a retransmission is answered with the remembered ACK
+
+ACK_CACHE = registry.register(Counter(
+    'ipms_ack_cache_total', 'Inbound messages answered from the ACK cache (hit) or handled (miss)', ('result',)))
+
+
+def cache_key(message):
+    """MSH-3, MSH-4 and MSH-10 of a raw message (control IDs are only unique per sender), None without MSH-10."""
+    msh = message.lstrip().replace('\n', '\r').split('\r', 1)[0]
+    if not msh.startswith('MSH'):
+        return None
+    fields = msh.split(msh[3:4] or '|')
+    if len(fields) < 10 or not fields[9]:
+        return None
+    return fields[2], fields[3], fields[9]
+
+
+class AckCache:
+    """The ACKs of the last ``size`` messages handled, by sender and control ID, for ``ttl`` seconds.
+
+    A retransmission (same MSH-3/4/10) within the TTL gets the original ACK back without the
+    handler running again, so it neither re-registers the patient nor schedules a second
+    response. A copy arriving while the first is still being handled waits for its ACK.
+    Least recently used entries are evicted first.
+    """
+    def __init__(self, size=ACK_CACHE_SIZE, ttl=ACK_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expiry, ACK), least recently used first
+        self._in_flight = {}  # key -> Event set once the first copy is handled
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def reply(self, message, handle):
+        """ACK of ``message``: the remembered one, or ``handle()``'s, which returns ``(ACK, cacheable)``."""
+        key = cache_key(message) if self.size > 0 and isinstance(message, str) else None
+        if key is None:
+            return handle()[0]
+        while True:
+            with self._lock:
+                entry = self._lookup(key)
+                if entry is not None:
+                    ACK_CACHE.inc(result='hit')
+                    return entry[1]
+                in_flight = self._in_flight.get(key)
+                if in_flight is None:
+                    self._in_flight[key] = threading.Event()
+                    break
+            in_flight.wait()
+
+        ACK_CACHE.inc(result='miss')
+        ack, cacheable = None, False
+        try:
+            ack, cacheable = handle()
+            return ack
+        finally:
+            with self._lock:
+                if cacheable:
+                    self._entries[key] = (time.monotonic() + self.ttl, ack)
+                    while len(self._entries) > self.size:
+                        self._entries.popitem(last=False)
+                self._in_flight.pop(key).set()
+
+    def _lookup(self, key):
+        now = time.monotonic()
+        # Drop the expired entries at the old end first, then the one asked for if it expired too
+        while self._entries:
+            oldest = next(iter(self._entries.values()))
+            if oldest[0] > now:
+                break
+            self._entries.popitem(last=False)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= now:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+
+ack_cache = AckCache()
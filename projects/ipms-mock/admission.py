@@ -0,0 +1,59 @@
+import os
+import threading
+from contextlib import contextmanager
+
+from metrics import Counter, registry
+from scheduler import SchedulerFull, response_scheduler
+
+MAX_IN_FLIGHT = int(os.getenv('MAX_IN_FLIGHT', '256'))  # Messages handled at once, 0 for no limit
+RESPONSES_PER_MESSAGE = 2  # Scheduler slots reserved per message: its response and a fault-profile duplicate
+RETRY_AFTER = float(os.getenv('RETRY_AFTER', '5'))  # Seconds the overload ACKs ask the sender to wait before retrying
+
+REJECTED = registry.register(Counter(
+    'ipms_admission_rejected_total', 'Inbound messages answered AR because the mock was overloaded',
+    ('message_type', 'reason')))
+
+
+class Overloaded(Exception):
+    """Raised instead of handling a message the mock has no room for; ``reason`` labels the rejection."""
+    def __init__(self, reason, detail, retry_after=RETRY_AFTER):
+        super().__init__(f"{detail}, retry after {retry_after:g} seconds")
+        self.reason = reason
+
+
+class AdmissionControl:
+    """Refuses messages up front rather than queueing work the mock cannot keep up with.
+
+    At most ``max_in_flight`` messages are handled at once. Each admitted message also
+    reserves its responses' scheduler slots before the handler runs, so a message the
+    scheduler has no room for is refused before its patient is stored.
+    """
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT, scheduler=response_scheduler):
+        self.max_in_flight = max_in_flight
+        self.scheduler = scheduler
+        self._slots = threading.BoundedSemaphore(max_in_flight) if max_in_flight > 0 else None
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    def in_flight(self):
+        return self._in_flight
+
+    @contextmanager
+    def admit(self):
+        if self._slots is not None and not self._slots.acquire(blocking=False):
+            raise Overloaded('in_flight', f"{self.max_in_flight} messages already being handled")
+        with self._lock:
+            self._in_flight += 1
+        try:
+            with self.scheduler.reserve(RESPONSES_PER_MESSAGE):
+                yield
+        except SchedulerFull as e:
+            raise Overloaded('pending_responses', str(e)) from None
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+            if self._slots is not None:
+                self._slots.release()
+
+
+admission = AdmissionControl()
@@ -0,0 +1,150 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from hl7apy.parser import get_message_type
+from hl7apy.exceptions import ParserError
+from hl7apy.mllp import InvalidHL7Message, UnsupportedMessageType
+
+from mllp import START_BLOCK, END_BLOCK
+
+
+class AsyncMLLPServer:
+    """asyncio counterpart of hl7apy's MLLPServer.
+
+    Takes the same ``handlers`` mapping (message type -> (handler class, *args)) and
+    serves every connection as a coroutine on a single event loop instead of a thread.
+    Only framing and writes run on the loop: the handlers (parsing, DataStore writes) run
+    on a pool of ``handler_threads`` threads, so a slow one does not stall the other
+    connections. With ``max_in_flight`` set, a message arriving while that many are being
+    handled is not queued for a thread: ``overloaded(message)`` builds its reply on the
+    loop instead. Connections are kept open so a client may send several frames on one socket; they
+    are closed after ``timeout`` seconds without a complete frame. With ``sock`` it accepts
+    on that listening socket instead of binding ``host``/``port``. ``shutdown`` stops
+    accepting and lets open connections finish their current frame, for at most
+    ``drain_timeout`` seconds, before ``serve_forever`` returns.
+    """
+    def __init__(self, host, port, handlers, timeout=10, encoding='utf-8', backlog=4096,
+                 max_frame_size=1024 * 1024, sock=None, drain_timeout=15, handler_threads=None,
+                 max_in_flight=None, overloaded=None):
+        self.host = host
+        self.port = port
+        self.handlers = handlers
+        self.timeout = timeout
+        self.encoding = encoding
+        self.backlog = backlog
+        self.max_frame_size = max_frame_size
+        self.sock = sock
+        self.drain_timeout = drain_timeout
+        self.handler_threads = handler_threads
+        self.max_in_flight = max_in_flight
+        self.overloaded = overloaded
+        self._in_flight = 0  # Messages handed to the executor and not answered yet, only touched on the loop
+        self._executor = None
+        self._loop = None
+        self._server = None
+        self._connections = set()
+        self._draining = False
+
+    def serve_forever(self):
+        asyncio.run(self.serve())
+
+    def shutdown(self):
+        """Safe to call from any thread, returns at once."""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stop_accepting)
+
+    def server_close(self):
+        pass  # serve_forever has already closed the listener and drained the connections
+
+    def _stop_accepting(self):
+        self._draining = True
+        self._server.close()
+
+    async def serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._executor = ThreadPoolExecutor(self.handler_threads, thread_name_prefix='mllp-handler')
+        if self.sock is not None:
+            server = await asyncio.start_server(self._handle_connection, sock=self.sock, limit=self.max_frame_size)
+        else:
+            server = await asyncio.start_server(
+                self._handle_connection, self.host, self.port,
+                backlog=self.backlog, reuse_address=True, limit=self.max_frame_size)
+        self._server = server
+        async with server:
+            try:
+                await server.serve_forever()
+            except asyncio.CancelledError:
+                if not self._draining:
+                    raise
+            if self._connections:
+                _, unfinished = await asyncio.wait(set(self._connections), timeout=self.drain_timeout)
+                for task in unfinished:
+                    task.cancel()
+        self._executor.shutdown(wait=True)  # Handlers already running still finish
+
+    async def _handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                try:
+                    frame = await asyncio.wait_for(reader.readuntil(END_BLOCK), self.timeout)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except asyncio.LimitOverrunError:
+                    logging.warning("MLLP frame exceeds the stream limit, closing connection")
+                    break
+
+                # Anything before the start block (e.g. a trailing CR after the previous frame) is ignored
+                start = frame.find(START_BLOCK)
+                if start == -1:
+                    continue
+                message = frame[start + 1:-len(END_BLOCK)].decode(self.encoding)
+
+                try:
+                    if self.overloaded is not None and self.max_in_flight and self._in_flight >= self.max_in_flight:
+                        response = self.overloaded(message)
+                    else:
+                        self._in_flight += 1
+                        try:
+                            response = await self._loop.run_in_executor(self._executor, self._route_message, message)
+                        finally:
+                            self._in_flight -= 1
+                except Exception:
+                    # Same behaviour as hl7apy's MLLPRequestHandler: no reply, drop the connection
+                    break
+
+                if isinstance(response, str):
+                    response = response.encode(self.encoding)
+                writer.write(response)
+                await writer.drain()
+                if self._draining:
+                    break
+        finally:
+            self._connections.discard(task)
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    def _route_message(self, msg):
+        try:
+            try:
+                msg_type = get_message_type(msg)
+            except ParserError:
+                raise InvalidHL7Message
+
+            try:
+                handler, args = self.handlers[msg_type][0], self.handlers[msg_type][1:]
+            except KeyError:
+                raise UnsupportedMessageType(msg_type)
+
+            return handler(msg, *args).reply()
+        except Exception as e:
+            try:
+                err_handler, args = self.handlers['ERR'][0], self.handlers['ERR'][1:]
+            except KeyError:
+                raise e
+            else:
+                return err_handler(e, msg, *args).reply()
@@ -1,42 +1,164 @@
 import os
+import queue
+import select
+import signal
+import socket
 import subprocess
 import sys
+import threading
+import time
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
+from lifecycle import LISTEN_BACKLOG
+
+SERVER_DOMAIN = os.getenv('SERVER_DOMAIN', 'localhost')
+SERVER_PORT = int(os.getenv('SERVER_PORT', '2575'))
+RELOAD_DEBOUNCE = float(os.getenv('RELOAD_DEBOUNCE', '0.5'))  # Seconds of quiet after a change before reloading
+WORKER_READY_TIMEOUT = float(os.getenv('WORKER_READY_TIMEOUT', '30'))  # Seconds a new server gets to come up
+WORKER_STOP_TIMEOUT = float(os.getenv('WORKER_STOP_TIMEOUT', '30'))  # Seconds before a stopping server is killed
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+
+
+class Worker:
+    """A server.py process accepting on the supervisor's listening socket."""
+    def __init__(self, sock, events):
+        ready_read, ready_write = os.pipe()
+        takeover_read, takeover_write = os.pipe()
+        env = dict(os.environ, LISTEN_FD=str(sock.fileno()), READY_FD=str(ready_write),
+                   TAKEOVER_FD=str(takeover_read))
+        self.process = subprocess.Popen([sys.executable, SERVER_SCRIPT], env=env,
+                                        pass_fds=(sock.fileno(), ready_write, takeover_read),
+                                        start_new_session=True)  # Ctrl-C reaches the supervisor only, which stops the server
+        os.close(ready_write)
+        os.close(takeover_read)
+        self._ready = ready_read
+        self._takeover = takeover_write
+        threading.Thread(target=lambda: events.put(('exited', self, self.process.wait())), daemon=True).start()
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def wait_ready(self, timeout=WORKER_READY_TIMEOUT):
+        """True once the server accepts connections, False if it exits or times out first."""
+        try:
+            readable, _, _ = select.select([self._ready], [], [], timeout)
+            return bool(readable) and os.read(self._ready, 1) == b'R'
+        finally:
+            os.close(self._ready)
+
+    def take_over(self):
+        """Lets the server accept connections, load the patients and adopt the pending responses."""
+        os.write(self._takeover, b'G')
+        os.close(self._takeover)
+        self._takeover = None
+
+    def stop(self, timeout=WORKER_STOP_TIMEOUT):
+        # SIGTERM lets the server finish its connections and save its pending responses
+        self.process.terminate()
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            print(f"Server {self.pid} did not stop within {timeout}s, killing it")
+            self.process.kill()
+            self.process.wait()
+        if self._takeover is not None:
+            os.close(self._takeover)  # Never taken over
+            self._takeover = None
+
+
 class ChangeHandler(FileSystemEventHandler):
-    """Handler for restarting the server if a Python file changes."""
-    def __init__(self, process):
-        self.process = process
-
-    def on_modified(self, event):
-        if event.src_path.endswith('.py'):
-            print(f"Detected change in {event.src_path}, restarting server...")
-            self.restart_server()
-
-    def restart_server(self):
-        if self.process:
-            self.process.terminate()  # Terminate the old process
-            self.process.wait()       # Wait for the process to fully terminate
-        # Start a new process
-        self.process = subprocess.Popen([sys.executable, 'server.py'])
+    """Reports changes to Python files; opening and reading them is ignored."""
+    def __init__(self, events):
+        self.events = events
+
+    def on_any_event(self, event):
+        if event.event_type not in ('modified', 'created', 'moved', 'deleted') or event.is_directory:
+            return
+        paths = (event.src_path, getattr(event, 'dest_path', ''))
+        changed = next((path for path in paths if path.endswith('.py')), None)
+        if changed:
+            self.events.put(('changed', changed))
+
+
+def listen():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((SERVER_DOMAIN, SERVER_PORT))
+    sock.listen(LISTEN_BACKLOG)
+    sock.set_inheritable(True)
+    return sock
+
+
+def reload(sock, events, worker):
+    """Starts a new server and hands over to it from ``worker`` (None if it exited) once it is up.
+
+    The new server only accepts connections after ``worker`` finished its open ones and exited;
+    meanwhile the listening socket stays open and queues them, so clients never see a refused connection.
+    """
+    new_worker = Worker(sock, events)
+    if not new_worker.wait_ready():
+        new_worker.stop()
+        if worker is None:
+            print(f"Server {new_worker.pid} did not come up, waiting for the next change")
+            return None
+        print(f"New server {new_worker.pid} did not come up, keeping server {worker.pid}")
+        return worker
+    if worker is not None:
+        worker.stop()
+        print(f"Server {new_worker.pid} replaced server {worker.pid}")
+    new_worker.take_over()
+    return new_worker
+
+
+def wait_for_quiet(events, first_path):
+    """Collects the changes of one edit (editors often write several events) until RELOAD_DEBOUNCE passes."""
+    changed = {first_path}
+    deadline = time.monotonic() + RELOAD_DEBOUNCE
+    while (remaining := deadline - time.monotonic()) > 0:
+        try:
+            event = events.get(timeout=remaining)
+        except queue.Empty:
+            break
+        if event[0] != 'changed':
+            events.put(event)  # Handled by the main loop after the reload
+            break
+        changed.add(event[1])
+    return changed
+
 
 if __name__ == "__main__":
-    path = os.path.dirname(os.path.abspath('server.py'))  # Path to watch
-    initial_process = subprocess.Popen([sys.executable, 'server.py'])
+    path = os.path.dirname(SERVER_SCRIPT)  # Path to watch
+    events = queue.SimpleQueue()  # put() may be called from the signal handler
+    sock = listen()
+
+    def _stop(signum, frame):
+        events.put(('stop',))
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    worker = reload(sock, events, None)
     observer = Observer()
-    event_handler = ChangeHandler(initial_process)
-    observer.schedule(event_handler, path, recursive=True)
+    observer.schedule(ChangeHandler(events), path, recursive=True)
     observer.start()
-    print("Watching for file changes in", path)
-
-    try:
-        while True:
-            pass
-    except KeyboardInterrupt:
-        observer.stop()
-        if initial_process:
-            initial_process.terminate()
-            initial_process.wait()
+    print(f"Listening on {SERVER_DOMAIN}:{SERVER_PORT}, watching for file changes in", path)
+
+    while True:
+        event = events.get()
+        if event[0] == 'stop':
+            break
+        if event[0] == 'changed':
+            changed = wait_for_quiet(events, event[1])
+            print(f"Detected change in {', '.join(sorted(changed))}, reloading server...")
+            worker = reload(sock, events, worker)
+        elif event[0] == 'exited' and event[1] is worker:
+            print(f"Server {worker.pid} exited with code {event[2]}, waiting for the next change")
+            worker = None
+
+    observer.stop()
+    if worker is not None:
+        worker.stop()
     observer.join()
-    
+    sock.close()
@@ -1,9 +1,193 @@
+import atexit
 import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 
-class DataStore:
-    def __init__(self, data_file="data.json"):
+DATASTORE_MODE = os.getenv('DATASTORE_MODE', 'json')  # Storage backend: 'json', 'journal' or 'sqlite'
+JOURNAL_FSYNC_RECORDS = int(os.getenv('JOURNAL_FSYNC_RECORDS', '64'))  # fsync after this many appended records...
+JOURNAL_FSYNC_INTERVAL = float(os.getenv('JOURNAL_FSYNC_INTERVAL', '1'))  # ...or after this many seconds
+JOURNAL_COMPACT_BYTES = int(os.getenv('JOURNAL_COMPACT_BYTES', str(64 * 1024 * 1024)))  # Journal size that triggers compaction
+DATASTORE_FLUSH_MS = float(os.getenv('DATASTORE_FLUSH_MS', '5'))  # Group commit interval, 0 writes every set synchronously
+DATASTORE_FLUSH_RECORDS = int(os.getenv('DATASTORE_FLUSH_RECORDS', '256'))  # Flush early once this many sets are waiting
+DATASTORE_MAX_PENDING = int(os.getenv('DATASTORE_MAX_PENDING', '10000'))  # Sets block while this many are waiting
+SQLITE_BUSY_TIMEOUT = float(os.getenv('SQLITE_BUSY_TIMEOUT', '5'))  # Seconds a writer waits for another writer's lock
+SQLITE_POOL_SIZE = int(os.getenv('SQLITE_POOL_SIZE', '8'))  # Connections shared by all threads, more wait for a free one
+
+# HL7 identifier type (CX-5) -> SQLite column: the Omang is the store key, the others are
+# the identifiers store_patient generates and the patient account number
+IDENTIFIER_COLUMNS = {
+    'SS': 'key',
+    'MR': 'mr',
+    'PI': 'pi',
+    'HUB': 'hub',
+    'AN': 'account',
+}
+
+
+def patient_identifiers(patient):
+    """The (identifier type, value) pairs a stored patient can be found by, besides its key."""
+    identifiers = patient.get('identifiers') or {}
+    pairs = [
+        ('MR', identifiers.get('mr')),
+        ('PI', identifiers.get('pi')),
+        ('HUB', identifiers.get('hub')),
+        ('AN', patient.get('patient_account_number')),
+    ]
+    return [(id_type, value) for id_type, value in pairs if value]
+
+
+class IdentifierIndex:
+    """Maps every (identifier type, value) pair of the patients added to the patient key.
+
+    Re-adding a key replaces the pairs of its previous value, so the index never points
+    at identifiers a patient no longer has. Lookups are a single dict access.
+    """
+    def __init__(self):
+        self._keys = {}  # (identifier type, value) -> key
+        self._pairs = {}  # key -> pairs it was indexed under
+
+    def add(self, key, patient):
+        self.discard(key)
+        pairs = patient_identifiers(patient) if isinstance(patient, dict) else []
+        for pair in pairs:
+            self._keys[pair] = key
+        self._pairs[key] = pairs
+
+    def discard(self, key):
+        for pair in self._pairs.pop(key, ()):
+            if self._keys.get(pair) == key:
+                del self._keys[pair]
+
+    def get(self, id_type, value):
+        return self._keys.get((id_type, value))
+
+
+class Journal:
+    """Append-only log of ``[key, value]`` JSON lines next to the data file.
+
+    Records are written through to the OS on every append and fsynced in batches, every
+    ``fsync_records`` records or ``fsync_interval`` seconds. Once the journal grows past
+    ``compact_bytes`` it is rotated to ``<path>.old`` and a background thread folds it
+    into a fresh snapshot of the data file, then deletes it.
+    """
+    def __init__(self, path, snapshot, fsync_records=JOURNAL_FSYNC_RECORDS,
+                 fsync_interval=JOURNAL_FSYNC_INTERVAL, compact_bytes=JOURNAL_COMPACT_BYTES):
+        self.path = path
+        self.old_path = path + ".old"
+        self.fsync_records = fsync_records
+        self.fsync_interval = fsync_interval
+        self.compact_bytes = compact_bytes
+        self._snapshot = snapshot  # Callable returning (data file path, copy of the data to write)
+        self._lock = threading.Lock()
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._unsynced = 0
+        self._compacting = False
+        self._syncer = threading.Thread(target=self._sync_periodically, name="journal-fsync", daemon=True)
+        self._syncer.start()
+
+    def replay(self):
+        """Yields the (key, value) records of a previous run, oldest first."""
+        for path in (self.old_path, self.path):
+            try:
+                f = open(path, "r", encoding="utf-8")
+            except FileNotFoundError:
+                continue
+            with f:
+                for number, line in enumerate(f, 1):
+                    try:
+                        key, value = json.loads(line)
+                    except ValueError:
+                        # A crash mid-append leaves a torn last line; nothing after it was acknowledged as written
+                        logging.warning("Ignoring unreadable journal record %s:%s", path, number)
+                        continue
+                    yield key, value
+
+    def append(self, key, value):
+        record = json.dumps([key, value]) + "\n"
+        with self._lock:
+            self._file.write(record)
+            self._file.flush()
+            self._unsynced += 1
+            if self._unsynced >= self.fsync_records:
+                self._sync()
+            snapshot = None
+            if not self._compacting and self._file.tell() >= self.compact_bytes:
+                snapshot = self._rotate()
+        if snapshot is not None:
+            threading.Thread(target=self._compact, args=snapshot, name="journal-compaction", daemon=True).start()
+
+    def compact(self):
+        """Folds the journal into the data file now, in the calling thread."""
+        with self._lock:
+            if self._compacting:
+                return
+            snapshot = self._rotate()
+        self._compact(*snapshot)
+
+    def close(self):
+        with self._lock:
+            self._sync()
+            self._file.close()
+
+    def _sync(self):
+        if self._unsynced:
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+
+    def _sync_periodically(self):
+        while True:
+            time.sleep(self.fsync_interval)
+            with self._lock:
+                if self._file.closed:
+                    return
+                self._sync()
+
+    def _rotate(self):
+        # Called with the lock held: everything journaled so far moves to <path>.old and the
+        # snapshot is taken at the same point, so it covers every rotated record
+        self._compacting = True
+        self._sync()
+        self._file.close()
+        if os.path.exists(self.old_path):
+            # A previous compaction did not finish, keep its records ahead of ours
+            with open(self.path, "r", encoding="utf-8") as src, open(self.old_path, "a", encoding="utf-8") as dst:
+                dst.write(src.read())
+            os.remove(self.path)
+        else:
+            os.replace(self.path, self.old_path)
+        self._file = open(self.path, "a", encoding="utf-8")
+        return self._snapshot()
+
+    def _compact(self, data_file, data):
+        try:
+            tmp_file = data_file + ".tmp"
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, data_file)
+            os.remove(self.old_path)
+            logging.info("Compacted %s into %s", self.path, data_file)
+        except Exception:
+            logging.exception("Journal compaction failed, records stay in %s", self.old_path)
+        finally:
+            with self._lock:
+                self._compacting = False
+
+
+class JsonBackend:
+    """Keeps every patient in memory and rewrites the whole data file on each set."""
+    def __init__(self, data_file):
         self.data_file = data_file
         self._data = self._load_data()
+        self._index = IdentifierIndex()
+        for key, value in self._data.items():
+            self._index.add(key, value)
 
     def _load_data(self):
         try:
@@ -16,9 +200,315 @@ class DataStore:
         return self._data.get(key, default)
 
     def set(self, key, value):
-        self._data[key] = value
+        self.set_many([(key, value)])
+
+    def set_many(self, items):
+        for key, value in items:
+            self._data[key] = value
+            self._index.add(key, value)
         self._save_data()
 
+    def find(self, id_type, value):
+        if id_type == 'SS':
+            return value if value in self._data else None
+        return self._index.get(id_type, value)
+
+    def size(self):
+        return len(self._data)
+
+    def close(self):
+        pass
+
     def _save_data(self):
         with open(self.data_file, "w") as f:
             json.dump(self._data, f)
+
+
+class JournalBackend(JsonBackend):
+    """In memory like :class:`JsonBackend`, but each set is appended to a :class:`Journal`."""
+    def __init__(self, data_file):
+        super().__init__(data_file)
+        self._journal = Journal(data_file + ".journal", self._snapshot)
+        for key, value in self._journal.replay():
+            self._data[key] = value
+            self._index.add(key, value)
+
+    def set_many(self, items):
+        for key, value in items:
+            self._data[key] = value
+            self._index.add(key, value)
+            self._journal.append(key, value)
+
+    def close(self):
+        self._journal.close()
+
+    def _snapshot(self):
+        # Taken while the journal rotates, from the thread doing the set
+        return self.data_file, dict(self._data)
+
+
+class SqliteBackend:
+    """Patients stored in a SQLite database in WAL mode, nothing is kept in memory.
+
+    Each patient is one row holding its JSON, with indexed columns for the MR, PI and HUB
+    identifiers and the account number. Threads check a connection out of a pool of at
+    most ``pool_size`` for each call and wait when all are in use, so short-lived handler
+    threads do not each hold one open. WAL lets readers run alongside a writer, and writers
+    queue on the database lock for up to ``busy_timeout`` seconds. An existing JSON data
+    file is imported into a new database.
+    """
+    COLUMNS = {id_type: column for id_type, column in IDENTIFIER_COLUMNS.items() if column != 'key'}
+
+    def __init__(self, path, import_file=None, busy_timeout=SQLITE_BUSY_TIMEOUT, pool_size=SQLITE_POOL_SIZE):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._idle = queue.LifoQueue()  # Most recently used first, so a light load keeps reusing one
+        self._free_slots = threading.BoundedSemaphore(max(pool_size, 1))
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+        with self._db() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            columns = ", ".join(f"{column} TEXT" for column in self.COLUMNS.values())
+            db.execute(f"CREATE TABLE IF NOT EXISTS patients (key TEXT PRIMARY KEY, {columns}, data TEXT NOT NULL)")
+            for column in self.COLUMNS.values():
+                db.execute(f"CREATE INDEX IF NOT EXISTS patients_{column} ON patients ({column})")
+            empty = not db.execute("SELECT 1 FROM patients LIMIT 1").fetchone()
+        if import_file and empty:
+            self._import(import_file)
+
+    @contextmanager
+    def _db(self):
+        """Checks a connection out of the pool for the duration of the block."""
+        self._free_slots.acquire()
+        try:
+            try:
+                db = self._idle.get_nowait()
+            except queue.Empty:
+                db = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None,
+                                     check_same_thread=False)
+                # WAL stays consistent after a crash with synchronous=NORMAL, it only loses the last commits
+                db.execute("PRAGMA synchronous=NORMAL")
+                with self._connections_lock:
+                    self._connections.append(db)
+            try:
+                yield db
+            finally:
+                self._idle.put(db)
+        finally:
+            self._free_slots.release()
+
+    def _row(self, key, value):
+        identifiers = dict(patient_identifiers(value)) if isinstance(value, dict) else {}
+        return (key, *(identifiers.get(id_type) for id_type in self.COLUMNS), json.dumps(value))
+
+    def _import(self, data_file):
+        try:
+            with open(data_file, "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        self.set_many(data.items())
+        logging.info("Imported %s patients from %s into %s", len(data), data_file, self.path)
+
+    def get(self, key, default=None):
+        with self._db() as db:
+            row = db.execute("SELECT data FROM patients WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, key, value):
+        self.set_many([(key, value)])
+
+    def set_many(self, items):
+        placeholders = ", ".join("?" * (len(self.COLUMNS) + 2))
+        with self._db() as db, db:
+            db.execute("BEGIN IMMEDIATE")
+            db.executemany(f"INSERT OR REPLACE INTO patients VALUES ({placeholders})",
+                           (self._row(key, value) for key, value in items))
+
+    def setdefault(self, key, value):
+        """Inserts ``value`` unless another connection (or process) stored ``key`` first; returns the stored value."""
+        placeholders = ", ".join("?" * (len(self.COLUMNS) + 2))
+        with self._db() as db, db:
+            db.execute("BEGIN IMMEDIATE")
+            if db.execute(f"INSERT OR IGNORE INTO patients VALUES ({placeholders})", self._row(key, value)).rowcount:
+                return value
+            row = db.execute("SELECT data FROM patients WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0])
+
+    def find(self, id_type, value):
+        column = IDENTIFIER_COLUMNS.get(id_type)
+        if column is None:
+            return None
+        with self._db() as db:
+            row = db.execute(f"SELECT key FROM patients WHERE {column} = ? LIMIT 1", (value,)).fetchone()
+        return row[0] if row else None
+
+    def size(self):
+        with self._db() as db:
+            return db.execute("SELECT COUNT(*) FROM patients").fetchone()[0]
+
+    def close(self):
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for db in connections:
+            db.close()
+
+
+def create_backend(mode, data_file):
+    if mode == "json":
+        return JsonBackend(data_file)
+    if mode == "journal":
+        return JournalBackend(data_file)
+    if mode == "sqlite":
+        return SqliteBackend(os.path.splitext(data_file)[0] + ".db", import_file=data_file)
+    raise ValueError(f"Unknown DATASTORE_MODE '{mode}', expected 'json', 'journal' or 'sqlite'")
+
+
+class DataStore:
+    """Patient store keyed by Omang, on top of a pluggable backend (see DATASTORE_MODE).
+
+    A backend is any object with ``get``, ``set_many``, ``find``, ``size`` and ``close``;
+    pass one as ``backend`` to use it instead of the configured mode. A backend shared
+    between processes (SQLite) also has an atomic ``setdefault``. The store is safe to
+    share between threads. ``set`` only queues the write and returns; a flusher thread hands
+    queued writes to the backend in one batch every ``flush_ms`` milliseconds, or as soon
+    as ``flush_records`` are waiting. Reads see queued writes immediately. With
+    ``flush_ms=0`` every ``set`` is written before it returns.
+    """
+    def __init__(self, data_file="data.json", mode=DATASTORE_MODE, backend=None,
+                 flush_ms=DATASTORE_FLUSH_MS, flush_records=DATASTORE_FLUSH_RECORDS,
+                 max_pending=DATASTORE_MAX_PENDING):
+        self.data_file = data_file
+        self.mode = mode
+        self.backend = backend if backend is not None else create_backend(mode, data_file)
+        self.flush_interval = flush_ms / 1000
+        self.flush_records = flush_records
+        self.max_pending = max_pending
+        self._condition = threading.Condition(threading.RLock())
+        self._pending = {}  # key -> value queued for the next batch
+        self._flushing = {}  # batch being written by the flusher, still visible to reads
+        self._queued_index = IdentifierIndex()  # Identifiers of the queued and flushing patients
+        self._flusher = None
+        self._closed = False
+
+    def get(self, key, default=None):
+        with self._condition:
+            for queued in (self._pending, self._flushing):
+                if key in queued:
+                    return queued[key]
+        return self.backend.get(key, default)
+
+    def set(self, key, value):
+        if not self.flush_interval:
+            with self._condition:
+                self.backend.set_many([(key, value)])
+            return
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("DataStore is closed")
+            while len(self._pending) >= self.max_pending:
+                self._condition.wait()  # The backend is falling behind, hold the writer back
+            self._start()
+            self._pending[key] = value
+            self._queued_index.add(key, value)
+            if len(self._pending) in (1, self.flush_records):
+                self._condition.notify_all()  # Start the flush interval, or cut it short
+
+    def setdefault(self, key, value):
+        """Stores ``value`` unless ``key`` already exists, atomically; returns the stored value."""
+        with self._condition:
+            existing = self.get(key)
+            if existing is not None:
+                return existing
+            backend_setdefault = getattr(self.backend, 'setdefault', None)
+            if backend_setdefault is None:
+                self.set(key, value)
+                return value
+        # Other --workers processes write the same database: insert now, not through the queue,
+        # and keep whichever patient reached the database first
+        return backend_setdefault(key, value)
+
+    def find(self, id_type, value):
+        """Key of the patient with the given identifier (type as in CX-5, e.g. MR), or None."""
+        with self._condition:
+            if id_type == 'SS':
+                if value in self._pending or value in self._flushing:
+                    return value
+            else:
+                key = self._queued_index.get(id_type, value)
+                if key is not None:
+                    return key
+        return self.backend.find(id_type, value)
+
+    def size(self):
+        """Number of patients stored, queued writes included."""
+        with self._condition:
+            queued = set(self._pending).union(self._flushing)
+        return self.backend.size() + sum(1 for key in queued if self.backend.get(key) is None)
+
+    def flush(self):
+        """Blocks until every set made so far has been written by the backend."""
+        with self._condition:
+            self._condition.notify_all()
+            while self._pending or self._flushing:
+                self._condition.wait()
+
+    def reopen(self):
+        """Loads the configured backend again, to see what another process stored since it was opened."""
+        with self._condition:
+            self.flush()
+            self.backend.close()
+            self.backend = create_backend(self.mode, self.data_file)
+
+    def close(self):
+        # The flusher writes whatever is still queued, then exits
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            self._condition.notify_all()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.backend.close()
+
+    def _start(self):
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._run, name="datastore-flusher", daemon=True)
+            self._flusher.start()
+            atexit.register(self.close)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._closed and not self._pending:
+                    self._condition.wait()
+                deadline = time.monotonic() + self.flush_interval
+                while not self._closed and len(self._pending) < self.flush_records:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                if self._closed and not self._pending:
+                    return
+                batch, self._pending, self._flushing = self._pending, {}, self._pending
+                self._condition.notify_all()
+            if not batch:
+                continue
+            try:
+                self.backend.set_many(batch.items())
+            except Exception:
+                with self._condition:
+                    if self._closed:
+                        logging.exception("Failed to write %s patients while closing, dropping them", len(batch))
+                    else:
+                        logging.exception("Failed to write %s patients, retrying", len(batch))
+                        # Sets made since keep precedence over the failed batch
+                        self._pending = {**batch, **self._pending}
+                time.sleep(self.flush_interval)
+            with self._condition:
+                for key in self._flushing:
+                    if key not in self._pending:
+                        self._queued_index.discard(key)
+                self._flushing = {}
+                self._condition.notify_all()
@@ -0,0 +1,234 @@
+from collections.abc import MutableMapping
+from hl7apy import check_version, get_default_version, load_reference
+from hl7apy.core import Field
+from hl7apy.exceptions import UnsupportedVersion
+
+# (segment name, version) -> ({field key: field number}, {numbers of composite fields}), built once per segment type
+_FIELD_KEYS = {}
+# (segment name, version) -> whether hl7apy knows the segment, looked up once per name
+_SEGMENT_NAMES = {}
+
+
+def field_key(long_name):
+    # Same key normalisation process_hl7_message has always used for hl7apy long names
+    return long_name.replace(" ", "_").replace("/", "").lower()
+
+
+def _field_keys(segment_name, version):
+    try:
+        return _FIELD_KEYS[(segment_name, version)]
+    except KeyError:
+        pass
+
+    keys = {}
+    composite = set()
+    try:
+        structure = load_reference(segment_name, 'Segment', version)
+    except Exception:
+        structure = None  # Z-segments and unknown segments only get positional keys
+
+    if structure is not None:
+        for child in structure[1]:
+            name = child[0]
+            number = int(name.rsplit('_', 1)[1])
+            long_name = Field(name, version=version).long_name
+            if long_name is not None:
+                keys.setdefault(field_key(long_name), number)
+            if child[1][0] == 'sequence':
+                composite.add(number)
+
+    _FIELD_KEYS[(segment_name, version)] = keys, composite
+    return keys, composite
+
+
+def _valid_segment_name(name, version):
+    # Same rule as hl7apy's Segment: Z-segments, or a segment of the version's reference
+    name = name.upper()
+    try:
+        return _SEGMENT_NAMES[(name, version)]
+    except KeyError:
+        pass
+    valid = name.startswith('Z') and len(name) == 3
+    if not valid:
+        try:
+            load_reference(name, 'Segment', version)
+            valid = True
+        except Exception:
+            valid = False
+    _SEGMENT_NAMES[(name, version)] = valid
+    return valid
+
+
+def _rstrip_empty(parts):
+    while parts and not parts[-1]:
+        parts.pop()
+    return parts
+
+
+class ER7Segment(MutableMapping):
+    """Dict-like view of one ER7 segment keyed by the fields' normalised hl7apy long names.
+
+    The segment is only split into fields on first access and only the fields that are
+    read get decoded. Values follow what hl7apy reports for ``field.value``: composite
+    fields lose their trailing empty components, repetitions are joined with ``~`` and
+    empty fields are absent. Assigned keys shadow the ER7 content.
+    """
+    def __init__(self, raw, name, version, encoding):
+        self.raw = raw
+        self.name = name
+        self.version = version
+        self._encoding = encoding
+        self._fields = None
+        self._values = {}
+
+    def _split(self):
+        if self._fields is None:
+            field_sep = self._encoding[0]
+            fields = self.raw.split(field_sep)
+            if self.name == 'MSH':
+                # MSH-1 is the field separator itself, so MSH-n lives at index n - 1
+                fields.insert(1, field_sep)
+            self._fields = fields
+        return self._fields
+
+    def _decode(self, number, composite):
+        fields = self._split()
+        if number >= len(fields) or not fields[number]:
+            return None
+        raw = fields[number]
+        if not composite:
+            return raw
+
+        # hl7apy drops trailing empty components of composite fields, repetition by repetition
+        component_sep, repetition_sep = self._encoding[1], self._encoding[2]
+        return repetition_sep.join(
+            component_sep.join(_rstrip_empty(repetition.split(component_sep)))
+            for repetition in raw.split(repetition_sep))
+
+    def _lookup(self, key):
+        keys, composite = _field_keys(self.name, self.version)
+        number = keys.get(key)
+        if number is None:
+            # Fields without a long name are keyed by position, e.g. zbr_3
+            prefix, _, position = key.rpartition('_')
+            if prefix != self.name.lower() or not position.isdigit() or int(position) in keys.values():
+                return None
+            number = int(position)
+        return self._decode(number, number in composite)
+
+    def __getitem__(self, key):
+        if key in self._values:
+            value = self._values[key]
+        else:
+            value = self._values[key] = self._lookup(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._values[key] = value
+
+    def __delitem__(self, key):
+        self[key]  # raise KeyError for keys that are not present
+        self._values[key] = None
+
+    def __iter__(self):
+        keys = {number: key for key, number in _field_keys(self.name, self.version)[0].items()}
+        seen = set()
+        for number in range(1, len(self._split())):
+            key = keys.get(number, f"{self.name.lower()}_{number}")
+            if key not in seen and key in self:
+                seen.add(key)
+                yield key
+        for key, value in self._values.items():
+            if key not in seen and value is not None:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def to_dict(self):
+        return {key: self[key] for key in self}
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+
+class ER7Message(MutableMapping):
+    """Lazy, dict-like view over an ER7 message, keyed by lower-case segment name.
+
+    A drop-in for the dict ``process_hl7_message`` builds from a full hl7apy parse: each
+    segment is an :class:`ER7Segment` and, as with the dict, the last occurrence of a
+    repeated segment wins. Nothing is decoded until it is read.
+
+    Messages hl7apy's ``parse_message`` rejects raise ValueError, so both parse modes answer
+    them with AE: bad MSH encoding characters, an unsupported or empty MSH-12 and unknown
+    segment names.
+    """
+    def __init__(self, message):
+        if not message.startswith('MSH') or len(message) < 8 or message[3].isspace():
+            raise ValueError("ER7 message must start with an MSH segment")
+        field_sep = message[3]
+        msh_fields = message.split('\r', 1)[0].split(field_sep)
+        encoding_chars = msh_fields[1]
+        if len(set(encoding_chars)) != len(encoding_chars) or len(encoding_chars) < 4:
+            raise ValueError(f"Invalid encoding chars '{encoding_chars}'")
+
+        if len(msh_fields) > 11:
+            # Like hl7apy, a missing MSH-12 means the default version but an empty one is rejected
+            self.version = msh_fields[11].strip().split(encoding_chars[0])[0]
+            try:
+                check_version(self.version)
+            except UnsupportedVersion as e:
+                raise ValueError(str(e)) from None
+        else:
+            self.version = get_default_version()
+        if len(encoding_chars) > 4 and (len(encoding_chars) > 5 or self.version < '2.7'):
+            raise ValueError(f"Invalid encoding chars '{encoding_chars}' for version {self.version}")
+        # field, component, repetition, escape, subcomponent
+        self.encoding = (field_sep, encoding_chars[0], encoding_chars[1], encoding_chars[2], encoding_chars[3])
+        self.raw = message
+
+        self._raw_segments = {}
+        for raw in message.split('\r'):
+            raw = raw.strip()
+            if raw:
+                if not _valid_segment_name(raw[:3], self.version):
+                    raise ValueError(f"Invalid name for Segment: {raw[:3]}")
+                self._raw_segments[raw[:3].lower()] = raw
+        self._segments = {}
+
+    def __getitem__(self, key):
+        try:
+            return self._segments[key]
+        except KeyError:
+            pass
+        raw = self._raw_segments.get(key)
+        if raw is None:
+            raise KeyError(key)
+        segment = self._segments[key] = ER7Segment(raw, raw[:3], self.version, self.encoding)
+        return segment
+
+    def __setitem__(self, key, value):
+        self._segments[key] = value
+
+    def __delitem__(self, key):
+        self[key]
+        self._segments.pop(key, None)
+        self._raw_segments.pop(key, None)
+
+    def __iter__(self):
+        yield from self._raw_segments
+        for key in self._segments:
+            if key not in self._raw_segments:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def to_dict(self):
+        return {key: dict(value) for key, value in self.items()}
+
+    def __repr__(self):
+        # Keep logging cheap: show the header instead of decoding every segment
+        return f"<ER7Message {self._raw_segments['msh']}>"
@@ -0,0 +1,220 @@
+import os
+import re
+from functools import lru_cache
+
+from hl7apy import get_default_version, load_library
+from hl7apy.base_datatypes import TextualDataType
+from hl7apy.core import Field, Segment, is_base_datatype
+from hl7apy.factories import datatype_factory
+
+RESPONSE_RENDERER = os.getenv('RESPONSE_RENDERER', 'template').lower()  # 'template' (precompiled ER7) or 'hl7apy'
+
+FIELD_SEP, COMPONENT_SEP, REPETITION_SEP, SUBCOMPONENT_SEP = '|', '^', '~', '&'
+MSH_ENCODING_CHARACTERS = '^~\\&'
+
+_PLACEHOLDER = re.compile(r'\{(\w+)(\*?)\}\Z')
+# hl7apy leaves an escape char alone when it is part of an escape sequence such as \F\
+_LONE_ESCAPE_CHAR = re.compile(r'(?<!\\[HNFSTRE])\\(?![HNFSTRE]\\)')
+_TRANSLATIONS = ((FIELD_SEP, '\\F\\'), (COMPONENT_SEP, '\\S\\'), (SUBCOMPONENT_SEP, '\\T\\'), (REPETITION_SEP, '\\R\\'))
+
+
+class _SlowPath(Exception):
+    """A value whose layout only hl7apy itself can be trusted to normalise."""
+
+
+def escape(value):
+    """Escapes a text value the way hl7apy's textual datatypes do."""
+    for char, sequence in _TRANSLATIONS:
+        value = value.replace(char, sequence)
+    return _LONE_ESCAPE_CHAR.sub(r'\\E\\', value)
+
+
+@lru_cache(maxsize=4096)
+def _encode_leaf(datatype, value, version):
+    # Dates and numbers are re-formatted by hl7apy (or kept as ST when they do not parse)
+    return datatype_factory(datatype, value, version).to_er7()
+
+
+def _leaf_encoder(datatype, version):
+    cls = load_library(version).get_base_datatypes().get(datatype or 'ST')
+    if cls is None or issubclass(cls, TextualDataType):
+        return escape
+    return lambda value: _encode_leaf(datatype, value, version) if value else ''
+
+
+def _is_base(datatype, version):
+    return datatype in (None, 'varies') or is_base_datatype(datatype, version)
+
+
+def _base_encoder(datatype, version, separators):
+    # hl7apy keeps every part of a base datatype value, empty or not, with the same datatype
+    leaf = _leaf_encoder(datatype if datatype != 'varies' else None, version)
+    if not separators:
+        return leaf
+    inner = _base_encoder(datatype, version, separators[1:])
+    separator = separators[0]
+    return lambda value: separator.join(inner(part) for part in value.split(separator))
+
+
+def _composite_encoder(children, separator):
+    # Named parts: empty ones are not created, so trailing ones disappear. Blank parts,
+    # parts beyond the datatype's structure and parts that end up empty follow rules
+    # specific to hl7apy's tree and are left to it.
+    def encode(value):
+        parts = value.split(separator)
+        if len(parts) > len(children):
+            raise _SlowPath()
+        encoded = []
+        for part, child in zip(parts, children):
+            if not part:
+                encoded.append('')
+                continue
+            if not part.strip():
+                raise _SlowPath()
+            text = child(part)
+            if not text:
+                raise _SlowPath()
+            encoded.append(text)
+        while encoded and not encoded[-1]:
+            encoded.pop()
+        return separator.join(encoded)
+    return encode
+
+
+def _child_datatypes(element):
+    names = sorted(element.structure_by_name, key=lambda name: int(name.rsplit('_', 1)[1]))
+    return [element.structure_by_name[name]['ref'][2] for name in names]
+
+
+def _component_encoder(component, version, separators):
+    if _is_base(component.datatype, version):
+        return _base_encoder(component.datatype, version, separators)
+    children = [_leaf_encoder(datatype, version) for datatype in _child_datatypes(component)]
+    return _composite_encoder(children, SUBCOMPONENT_SEP)
+
+
+def _field_encoder(segment_name, number, version):
+    field = Field(f"{segment_name}_{number}", version=version)
+    if _is_base(field.datatype, version):
+        return _base_encoder(field.datatype, version, (COMPONENT_SEP, SUBCOMPONENT_SEP))
+    children = [_component_encoder(child, version, (SUBCOMPONENT_SEP,)) for child in _components(field)]
+    return _composite_encoder(children, COMPONENT_SEP)
+
+
+def _components(field):
+    names = sorted(field.structure_by_name, key=lambda name: int(name.rsplit('_', 1)[1]))
+    return [getattr(field, name) for name in names]
+
+
+@lru_cache(maxsize=4096)
+def _hl7apy_field(segment_name, number, value, version):
+    field = getattr(Segment(segment_name, version=version), f"{segment_name}_{number}")
+    field.value = value
+    return field.to_er7()
+
+
+@lru_cache(maxsize=4096)
+def _hl7apy_component(segment_name, number, component, value, version):
+    field = Field(f"{segment_name}_{number}", version=version)
+    child = getattr(field, f"{field.datatype}_{component}")
+    child.value = value
+    return child.to_er7()
+
+
+class _Slot:
+    """Encodes one placeholder; values outside the fast encoder's rules go through hl7apy."""
+    def __init__(self, key, encoder, fallback, repeated=False):
+        self.key = key
+        self.encoder = encoder
+        self.fallback = fallback
+        self.repeated = repeated
+
+    def render(self, values):
+        value = values[self.key]
+        if self.repeated:
+            return REPETITION_SEP.join(self._encode(repetition) for repetition in value)
+        return self._encode(value)
+
+    def _encode(self, value):
+        try:
+            return self.encoder(value)
+        except _SlowPath:
+            return self.fallback(value)
+
+
+class ER7Template:
+    """An ER7 message layout compiled once into literal text and value slots.
+
+    ``segments`` is a list of ``(segment name, {field number: layout})``. A layout is
+    literal ER7, a ``{key}`` placeholder filling the whole field, a ``{key*}`` placeholder
+    filling one repetition per item of a list, or components and repetitions where whole
+    components are ``{key}`` placeholders. Rendering produces exactly what setting the same
+    values through hl7apy's ``.value`` and calling ``to_er7()`` would: literals are
+    normalised by hl7apy at compile time and values are split, escaped and trimmed by
+    encoders built from the field's datatype.
+    """
+    def __init__(self, segments, version=None):
+        self.version = version or get_default_version()
+        self._parts = []
+        for index, (segment_name, fields) in enumerate(segments):
+            if index:
+                self._literal('\r')
+            self._compile_segment(segment_name, fields)
+
+    def render(self, **values):
+        return ''.join(part if isinstance(part, str) else part.render(values) for part in self._parts)
+
+    def render_mllp(self, **values):
+        return f"{chr(11)}{self.render(**values)}{chr(28)}{chr(13)}"
+
+    def _literal(self, text):
+        if self._parts and isinstance(self._parts[-1], str):
+            self._parts[-1] += text
+        else:
+            self._parts.append(text)
+
+    def _compile_segment(self, segment_name, fields):
+        if segment_name == 'MSH':
+            self._literal(f"MSH{FIELD_SEP}{MSH_ENCODING_CHARACTERS}")
+            first = 3
+        else:
+            self._literal(segment_name)
+            first = 1
+        for number in range(first, max(fields, default=0) + 1):
+            self._literal(FIELD_SEP)
+            if number in fields:
+                self._compile_field(segment_name, number, fields[number])
+
+    def _compile_field(self, segment_name, number, layout):
+        version = self.version
+        placeholder = _PLACEHOLDER.match(layout)
+        if placeholder:
+            key, repeated = placeholder.groups()
+            self._parts.append(_Slot(key, _field_encoder(segment_name, number, version),
+                                     lambda value: _hl7apy_field(segment_name, number, value, version),
+                                     repeated=bool(repeated)))
+            return
+        if '{' not in layout:
+            self._literal(_hl7apy_field(segment_name, number, layout, version))
+            return
+
+        # Components set one by one, as add_field('PID_3').CX_1.value = ... does
+        components = _components(Field(f"{segment_name}_{number}", version=version))
+        for r, repetition in enumerate(layout.split(REPETITION_SEP)):
+            if r:
+                self._literal(REPETITION_SEP)
+            for c, component in enumerate(repetition.split(COMPONENT_SEP), 1):
+                if c > 1:
+                    self._literal(COMPONENT_SEP)
+                placeholder = _PLACEHOLDER.match(component)
+                if placeholder is None:
+                    if '{' in component:
+                        raise ValueError(f"Placeholders must fill whole components: {layout}")
+                    if component:
+                        self._literal(_hl7apy_component(segment_name, number, c, component, version))
+                    continue
+                key, repeated = placeholder.groups()
+                if repeated:
+                    raise ValueError(f"Only whole fields can be repeated: {layout}")
+                self._parts.append(_Slot(key, _component_encoder(components[c - 1], version, (SUBCOMPONENT_SEP,)),
+                                         lambda value, c=c: _hl7apy_component(segment_name, number, c, value, version)))
@@ -0,0 +1,152 @@
+import logging
+import math
+import os
+import random
+import threading
+import time
+
+import yaml
+
+from metrics import Counter, registry
+from scheduler import RESPONSE_DELAY
+
+FAULT_PROFILES = os.getenv('FAULT_PROFILES', '')  # YAML file of latency/fault profiles, unset keeps RESPONSE_DELAY and no faults
+FAULT_PROFILES_CHECK = float(os.getenv('FAULT_PROFILES_CHECK', '1'))  # Seconds between checks of the file for changes
+FAULT_SEED = os.getenv('FAULT_SEED') or None  # Makes the injected faults repeatable
+
+FAULTS = registry.register(Counter(
+    'ipms_faults_injected_total', 'Responses dropped, duplicated or reordered and ACKs turned into AE/AR',
+    ('message_type', 'fault')))
+
+PROBABILITIES = ('drop', 'duplicate', 'out_of_order', 'ack_error', 'ack_reject')
+
+
+class FaultProfile:
+    """How the responses to one inbound message type behave.
+
+    ``delay`` is seconds (``10``), ``{fixed: 10}``, ``{uniform: [5, 15]}`` or
+    ``{lognormal: {median: 8, sigma: 0.5, max: 60}}``. ``drop``, ``duplicate``,
+    ``out_of_order``, ``ack_error`` and ``ack_reject`` are probabilities. A duplicate follows
+    the response within ``duplicate_gap`` seconds (default 1); a response out of order is held
+    back up to ``reorder_window`` more seconds (default 30).
+    """
+    def __init__(self, spec):
+        unknown = set(spec) - {'delay', 'duplicate_gap', 'reorder_window', *PROBABILITIES}
+        if unknown:
+            raise ValueError(f"Unknown fault profile keys: {', '.join(sorted(unknown))}")
+        self.delay = _delay_distribution(spec.get('delay', RESPONSE_DELAY))
+        self.probabilities = {name: float(spec.get(name, 0)) for name in PROBABILITIES}
+        for name, probability in self.probabilities.items():
+            if not 0 <= probability <= 1:
+                raise ValueError(f"{name} must be a probability, got {probability}")
+        self.duplicate_gap = float(spec.get('duplicate_gap', 1))
+        self.reorder_window = float(spec.get('reorder_window', 30))
+
+
+def _delay_distribution(spec):
+    """A function drawing a delay (with a random.Random) from a delay spec."""
+    if isinstance(spec, (int, float)):
+        return lambda rng: float(spec)
+    if not isinstance(spec, dict) or len(spec) != 1:
+        raise ValueError(f"Delay must be seconds or one of fixed/uniform/lognormal, got {spec!r}")
+    (kind, value), = spec.items()
+    if kind == 'fixed':
+        return lambda rng: float(value)
+    if kind == 'uniform':
+        low, high = map(float, value)
+        return lambda rng: rng.uniform(low, high)
+    if kind == 'lognormal':
+        mu, sigma = math.log(float(value['median'])), float(value['sigma'])
+        cap = float(value.get('max', math.inf))
+        return lambda rng: min(rng.lognormvariate(mu, sigma), cap)
+    raise ValueError(f"Unknown delay distribution '{kind}', expected fixed, uniform or lognormal")
+
+
+def load_profiles(path):
+    """``(active profile name, {message type: FaultProfile})`` from a profiles file.
+
+    The file holds ``profiles``, each mapping inbound message types (``'*'`` for any other)
+    to their settings, and the name of the ``active`` one.
+    """
+    with open(path) as f:
+        document = yaml.safe_load(f) or {}
+    profiles = document.get('profiles') or {}
+    active = document.get('active')
+    if active not in profiles:
+        raise ValueError(f"Active fault profile '{active}' is not one of: {', '.join(profiles) or 'none'}")
+    return active, {message_type: FaultProfile(spec or {}) for message_type, spec in profiles[active].items()}
+
+
+class FaultProfiles:
+    """Response delays and faults of the active profile in ``path``.
+
+    The file is checked for changes at most every ``check_interval`` seconds, so editing it
+    (e.g. its ``active`` key) switches profiles at runtime. A file that fails to load is logged
+    and the previous profile kept. Without a file every response is sent once after
+    RESPONSE_DELAY.
+    """
+    def __init__(self, path=FAULT_PROFILES, check_interval=FAULT_PROFILES_CHECK, seed=FAULT_SEED):
+        self.path = path
+        self.check_interval = check_interval
+        self._random = random.Random(seed)
+        self._profiles = {}
+        self._mtime = None
+        self._checked = 0
+        self._lock = threading.Lock()
+
+    def _profile(self, message_type):
+        if not self.path:
+            return None
+        now = time.monotonic()
+        if now - self._checked >= self.check_interval:
+            with self._lock:
+                if now - self._checked >= self.check_interval:
+                    self._checked = now
+                    self._reload()
+        profiles = self._profiles
+        return profiles.get(message_type, profiles.get('*'))
+
+    def _reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime == self._mtime:
+                return
+            self._mtime = mtime
+            active, self._profiles = load_profiles(self.path)
+            logging.info("Using fault profile '%s' from %s", active, self.path)
+        except (OSError, ValueError, TypeError, KeyError, yaml.YAMLError) as e:
+            logging.error("Could not load fault profiles from %s, keeping the current one: %s", self.path, e)
+
+    def _chance(self, profile, fault, message_type):
+        if self._random.random() < profile.probabilities[fault]:
+            FAULTS.inc(message_type=message_type, fault=fault)
+            return True
+        return False
+
+    def response_delays(self, message_type):
+        """Delays after which to send the response to ``message_type``: none when dropped, two when duplicated."""
+        profile = self._profile(message_type)
+        if profile is None:
+            return [RESPONSE_DELAY]
+        if self._chance(profile, 'drop', message_type):
+            return []
+        delay = profile.delay(self._random)
+        if self._chance(profile, 'out_of_order', message_type):
+            delay += self._random.uniform(0, profile.reorder_window)
+        if self._chance(profile, 'duplicate', message_type):
+            return [delay, delay + self._random.uniform(0, profile.duplicate_gap)]
+        return [delay]
+
+    def ack_fault(self, message_type):
+        """'AE' or 'AR' when the inbound ``message_type`` should be refused, otherwise None."""
+        profile = self._profile(message_type)
+        if profile is None:
+            return None
+        if self._chance(profile, 'ack_error', message_type):
+            return 'AE'
+        if self._chance(profile, 'ack_reject', message_type):
+            return 'AR'
+        return None
+
+
+fault_profiles = FaultProfiles()
@@ -1,22 +1,36 @@
 import logging
-import time
-from threading import Thread
 from hl7apy.core import Message, Segment
-from helper import create_ack_response, send_message_to_client, generate_code
+from helper import create_ack_response, send_message_to_client
+from identifiers import identifier_allocator
+from log_config import Redacted
+from scheduler import response_scheduler
+from faults import fault_profiles
+from er7_template import ER7Template, RESPONSE_RENDERER
 from datetime import datetime
 
-def store_patient(patient, datastore):    
+# Same layout create_adt_a04_hl7apy_message builds field by field, compiled once
+ADT_A04_RESPONSE_TEMPLATE = ER7Template([
+    ('MSH', {3: 'ADM', 5: '', 7: '{now}', 9: 'ADT^A04', 10: '279085', 11: 'D', 12: '2.4', 15: 'AL', 16: 'NE'}),
+    ('EVN', {1: '', 2: '{now}', 3: '', 4: '', 5: 'INFCE^INTERFACE', 6: '{now}', 7: ''}),
+    ('PID', {1: '1', 3: '{mr}^^^^MR^GGC~{ssn}^^^^SS^GGC~{pi}^^^^PI^GGC~{hub}^^^^HUB^GGC', 18: '{account}'}),
+    ('PV1', {1: '1', 2: 'O'}),
+    ('PV2', {3: '{task_id}', 35: 'N'}),
+])
+
+def store_patient(patient, datastore, allocator=identifier_allocator):
     existing_patient = datastore.get(patient['ssn_number_patient'])
     if existing_patient:
-        logging.info(f"Found existing Patient for '{patient['ssn_number_patient']}'")
+        logging.info("Found existing Patient for '%s'", Redacted(patient['ssn_number_patient']))
         return existing_patient
     else:
+        patient = dict(patient) # Materialise the (lazily parsed) PID segment before storing it
+
         # generate IPMS IDs
         patient["identifiers"] = {}
-        patient["identifiers"]["mr"] = generate_code() # Default format (GG000XXXXX)
-        patient["identifiers"]["pi"] = generate_code(zeros=0) # No zeros (GGXXXXX)
-        patient["identifiers"]["hub"] = generate_code(zeros=1, letters=4, digits=6) # One zero (GG0XXXXX)
-        patient["patient_account_number"] = generate_code(zeros=5, letters=2, digits=5) # 5 zeros (ZG00000XXXXX)
+        patient["identifiers"]["mr"] = allocator.allocate('mr') # Default format (GG000XXXXX)
+        patient["identifiers"]["pi"] = allocator.allocate('pi') # No zeros (GGXXXXX)
+        patient["identifiers"]["hub"] = allocator.allocate('hub') # One zero (GG0XXXXX)
+        patient["patient_account_number"] = allocator.allocate('account') # 5 zeros (ZG00000XXXXX)
 
         formatted_components = []
         for id_value, id_type, assigning_authority in [
@@ -32,9 +46,13 @@ def store_patient(patient, datastore):
         patient_identifier_list = "~".join(formatted_components)
         patient['patient_identifier_list'] = patient_identifier_list # Stored as a string representation
 
-        datastore.set(patient['ssn_number_patient'], patient)
+        stored = datastore.setdefault(patient['ssn_number_patient'], patient)
+        if stored is not patient:
+            # Another connection registered the same patient in the meantime, keep its IDs
+            logging.info("Found existing Patient for '%s'", Redacted(patient['ssn_number_patient']))
+            return stored
 
-        logging.info(f"Storing new Patient for '{patient['ssn_number_patient']}'")
+        logging.info("Storing new Patient for '%s'", Redacted(patient['ssn_number_patient']))
 
     return patient
     
@@ -46,17 +64,37 @@ def handle_adt_a04(incoming_message, datastore):
     # update patient with IPMS stored details
     incoming_message['pid'] = patient
 
-    logging.debug("Received ADT^A04, scheduling updated ADT^A04 response in 10 seconds")
-    Thread(target=schedule_adt_a04_response, args=(incoming_message,)).start()
-    response = create_ack_response(incoming_message)
-    return response.to_mllp()
+    schedule_adt_a04_response(incoming_message)
+    return create_ack_response(incoming_message)
 
 def schedule_adt_a04_response(data):
-    time.sleep(10)
+    # Usually once after RESPONSE_DELAY; the active fault profile may drop, delay or duplicate it
+    delays = fault_profiles.response_delays('ADT^A04')
+    logging.debug("Received ADT^A04, scheduling updated ADT^A04 response in %s seconds", delays)
+    for delay in delays:
+        response_scheduler.schedule(delay, send_adt_a04_response, data)
+
+def send_adt_a04_response(data):
     adt_a04_response_message = create_adt_a04_response_message(data)
     send_message_to_client(adt_a04_response_message)
 
 def create_adt_a04_response_message(data):
+    if RESPONSE_RENDERER == 'hl7apy':
+        return create_adt_a04_hl7apy_message(data)
+
+    identifiers = data['pid'].get('identifiers', {})
+    return ADT_A04_RESPONSE_TEMPLATE.render_mllp(
+        now=datetime.now().strftime("%Y%m%d%H%M"),
+        mr=identifiers.get("mr", ""),
+        ssn=data['pid'].get('ssn_number_patient', ""),
+        pi=identifiers.get("pi", ""),
+        hub=identifiers.get("hub", ""),
+        account=data['pid']["patient_account_number"],
+        task_id=data["pv2"]["accommodation_code"],
+    )
+
+def create_adt_a04_hl7apy_message(data):
+    # Builds the response as an hl7apy tree, the reference for ADT_A04_RESPONSE_TEMPLATE
     adt_a04 = Message()
 
     add_msh_segments(adt_a04)
@@ -1,48 +1,123 @@
 import logging
-import time
 import uuid
-from threading import Thread
 from hl7apy.core import Message
 from datetime import datetime, timedelta
 
 from helper import create_ack_response, send_message_to_client
-
-def extract_omang(identifiers_list):
+from scheduler import response_scheduler
+from faults import fault_profiles
+from er7_template import ER7Template, RESPONSE_RENDERER
+from log_config import Redacted
+from lab_results import observations
+
+# Same layout create_oru_r01_hl7apy_message builds field by field, compiled once
+ORU_R01_RESPONSE_TEMPLATE = ER7Template([
+    ('MSH', {3: 'ADM', 4: 'LAB', 5: '', 7: '{now}', 9: 'ORU^R01', 10: '{control_id}', 11: 'D', 12: '2.5'}),
+    ('PID', {1: '1', 2: '{mr}', 3: '{identifiers*}', 5: '{patient_name}', 6: '', 7: '{date_time_of_birth}',
+             8: '{administrative_sex}', 10: '{race}', 11: '{patient_address}', 13: '{phone_number_home}',
+             14: '{phone_number_business}', 16: '{marital_status}', 17: '{religion}',
+             18: '{patient_account_number}', 19: '{ssn_number_patient}'}),
+    ('OBR', {1: '1', 2: '{placer_order_number}', 3: '{filler_order_number}', 4: '{universal_service_identifier}',
+             7: '{observation_date_time}', 8: '{observation_date_time}', 14: '{specimen_source}',
+             16: '{ordering_provider}', 22: '{observation_date_time}', 24: 'LAB', 25: 'F',
+             32: 'ZZHGGMMO^Healthpost^Mmopane', 47: '{filler_order_number}'}),
+])
+# One OBX per result lab_results generates for the ordered test
+OBX_TEMPLATE = ER7Template([
+    ('OBX', {1: '{set_id}', 2: '{value_type}', 3: '{identifier}', 5: '{value}', 6: '{units}', 7: '{range}',
+             8: '{flag}', 10: 'A^S', 11: 'F', 14: '{observation_date_time}', 15: 'GNHL^National Health Laboratory^L'}),
+])
+ORU_R01_PID_FIELDS = ('patient_name', 'date_time_of_birth', 'administrative_sex', 'race', 'patient_address',
+                      'phone_number_home', 'phone_number_business', 'marital_status', 'religion',
+                      'patient_account_number', 'ssn_number_patient')
+
+# PID-3 identifier types a stored patient can be resolved by, tried in this order
+RESOLVABLE_IDENTIFIER_TYPES = ("SS", "MR", "PI", "HUB", "AN")
+
+def extract_identifiers(identifiers_list):
+    # Split the ~-separated PID-3 string once into {identifier type (CX-5): value (CX-1)}
+    identifiers = {}
     for identifier in identifiers_list.split("~"):
-        if identifier.endswith("^^^^SS^GGC"): # Omang Identifier codes
-            return identifier.split("^^^^")[0]  # Extract value before component separator
-    return None  # Return None if no OMANG identifier is found
+        components = identifier.split("^")
+        if len(components) > 4 and components[0] and components[4]:
+            identifiers.setdefault(components[4], components[0])
+    return identifiers
 
-def fetch_patient(patient_omang_id, datastore):    
-    existing_patient = datastore.get(patient_omang_id)
+def extract_omang(identifiers_list):
+    return extract_identifiers(identifiers_list).get("SS")  # None if no OMANG identifier is found
+
+def resolve_patient_key(identifiers, datastore):
+    # Omang first as before, then any identifier IPMS generated for the patient
+    for id_type in RESOLVABLE_IDENTIFIER_TYPES:
+        value = identifiers.get(id_type)
+        if value:
+            key = datastore.find(id_type, value)
+            if key is not None:
+                return key
+    return None
+
+def fetch_patient(patient_key, datastore):    
+    existing_patient = datastore.get(patient_key) if patient_key is not None else None
     if existing_patient:
-        logging.info(f"Found existing Patient for '{patient_omang_id}'")
+        logging.info("Found existing Patient for '%s'", Redacted(patient_key))
         return existing_patient
     else:
-        logging.error(f"Patient not found for '{patient_omang_id}'")
-        raise Exception(f"Patient not found for '{patient_omang_id}'")
+        logging.error("Patient not found for '%s'", Redacted(patient_key))
+        raise Exception(f"Patient not found for '{patient_key}'")
 
 def handle_orm_o01(incoming_message, datastore):
-    # extract omang ID from identifiers list
-    omang_id = extract_omang(incoming_message["pid"]['patient_identifier_list'])
-    # find (or store) patient in datastore if already processed
-    patient = fetch_patient(omang_id, datastore)
+    # resolve the patient through any identifier in the PID-3 list
+    identifiers = extract_identifiers(incoming_message["pid"].get('patient_identifier_list', ""))
+    patient_key = resolve_patient_key(identifiers, datastore)
+    if patient_key is None:
+        logging.error("Patient not found for identifiers %s", Redacted(identifiers))
+        raise Exception(f"Patient not found for identifiers {identifiers}")
+    patient = fetch_patient(patient_key, datastore)
 
     # update patient with IPMS stored details
     incoming_message['pid'] = patient
 
-    logging.debug("Received ORM^O01, scheduling ORU^O01 response in 10 seconds")
-    Thread(target=schedule_oru_o01_response, args=(incoming_message,)).start()
-    response = create_ack_response(incoming_message)
-    return response.to_mllp()
+    schedule_oru_o01_response(incoming_message)
+    return create_ack_response(incoming_message)
 
 def schedule_oru_o01_response(data):
-    time.sleep(10)
+    # Usually once after RESPONSE_DELAY; the active fault profile may drop, delay or duplicate it
+    delays = fault_profiles.response_delays('ORM^O01')
+    logging.debug("Received ORM^O01, scheduling ORU^O01 response in %s seconds", delays)
+    for delay in delays:
+        response_scheduler.schedule(delay, send_oru_o01_response, data)
+
+def send_oru_o01_response(data):
     orm_a01_response_message = create_oru_r01_response_message(data)
     send_message_to_client(orm_a01_response_message, True)
 
 def create_oru_r01_response_message(data):
-    # def create_oru_r01_response_message(self):
+    if RESPONSE_RENDERER == 'hl7apy':
+        return create_oru_r01_hl7apy_message(data)
+
+    pid = data["pid"]
+    values = {key: pid.get(key, "") for key in ORU_R01_PID_FIELDS}
+    observation_date_time = data["obr"].get("observation_date_time", "")
+    header = ORU_R01_RESPONSE_TEMPLATE.render(
+        now=datetime.now().strftime("%Y%m%d%H%M"),
+        control_id=uuid.uuid4().hex,
+        mr=pid.get("identifiers", {}).get("mr", ""),
+        identifiers=pid.get("patient_identifier_list", "").split("~"),
+        placer_order_number=data["orc"].get("placer_order_number", ""),
+        filler_order_number=data["orc"].get("filler_order_number", ""),
+        universal_service_identifier=data["obr"].get("universal_service_identifier", ""),
+        observation_date_time=observation_date_time,
+        specimen_source=data["obr"].get("specimen_source", ""),
+        ordering_provider=data["obr"].get("ordering_provider", ""),
+        **values,
+    )
+    results = observations(data["obr"].get("universal_service_identifier", ""))
+    segments = [OBX_TEMPLATE.render(set_id=str(set_id), observation_date_time=observation_date_time, **result)
+                for set_id, result in enumerate(results, 1)]
+    return f"{chr(11)}{chr(13).join([header, *segments])}{chr(28)}{chr(13)}"
+
+def create_oru_r01_hl7apy_message(data):
+    # Builds the response as an hl7apy tree, the reference for ORU_R01_RESPONSE_TEMPLATE
     oru_r01 = Message()
 
     # MSH Segment
@@ -173,19 +248,21 @@ def add_obr_segment(oru_r01, data):
     return obr
 
 def add_obx_segments(oru_r01, data):
-    # OBX-1
-    obx1 = oru_r01.add_segment("OBX")
-    obx1.OBX_1.value = "1"
-    obx1.OBX_2.value = "ST"
-    obx1.OBX_3.value = "CD4^CD4 count"
-    obx1.OBX_5.value = "450"
-    obx1.OBX_6.value = "cells/mm3"
-    obx1.OBX_7.value = "200-1500"
-    obx1.OBX_8.value = "N"
-    obx1.OBX_10.value = "A^S"
-    obx1.OBX_11.value = "F"
-    obx1.OBX_14.value = data["obr"].get("observation_date_time", "")
-    obx1.OBX_15.value = "GNHL^National Health Laboratory^L"
+    # One OBX per result of the test ordered in OBR-4 (see lab_results)
+    results = observations(data["obr"].get("universal_service_identifier", ""))
+    for set_id, result in enumerate(results, 1):
+        obx = oru_r01.add_segment("OBX")
+        obx.OBX_1.value = str(set_id)
+        obx.OBX_2.value = result["value_type"]
+        obx.OBX_3.value = result["identifier"]
+        obx.OBX_5.value = result["value"]
+        obx.OBX_6.value = result["units"]
+        obx.OBX_7.value = result["range"]
+        obx.OBX_8.value = result["flag"]
+        obx.OBX_10.value = "A^S"
+        obx.OBX_11.value = "F"
+        obx.OBX_14.value = data["obr"].get("observation_date_time", "")
+        obx.OBX_15.value = "GNHL^National Health Laboratory^L"
 
     return oru_r01  # Return the updated message object
 
@@ -1,49 +1,117 @@
 import os
+import time
 import uuid
 import logging
-import random
-import string
-from mllp_client import MLLPClient
-from hl7apy.core import Message
+from datetime import datetime
+from functools import lru_cache
+from mllp_client import MLLPClient, MLLP_PIPELINE_DEPTH, get_pipeline
+from er7_template import escape
+from metrics import STAGE_SECONDS, RESPONSES_SENT, SEND_FAILURES
+from log_config import OUTBOUND_LOG, Redacted
 
 MLLP_CLIENT_HOST = str(os.getenv('MLLP_CLIENT_HOST', 'host.docker.internal'))  # Default client host to send ADT A04/ORU message
 MLLP_CLIENT_PORT = int(os.getenv('MLLP_CLIENT_PORT', '3001'))  # Default client port to send ADT A04/ORU message
 MLLP_CLIENT_ORU_PORT = int(os.getenv('MLLP_CLIENT_ORU_PORT', '3002'))
 
-def create_error_response(self, error_msg):
-    logging.warning("Creating error response: %s", error_msg)
-    response = self.create_ack_response()
-    response.msa.msa_1 = 'AE'  # Error acknowledgment code
-    response.err.err_1 = error_msg
-    return response.to_mllp()
-
-def create_ack_response(incoming_message):
-    # Common method to create an ACK response for any message type
-    response = Message("ACK")
-    response.msh.msh_9 = 'ACK'
-    response.msh.msh_10 = uuid.uuid4().hex
-    response.msa.msa_1 = 'AA'  # Acknowledgment code
-    response.msa.msa_2 = incoming_message['msh']['message_control_id']
-    return response
+# HL7 table 0357 message error condition codes used in ERR-3
+UNSUPPORTED_MESSAGE_TYPE = '200'
+APPLICATION_INTERNAL_ERROR = '207'
+_ERROR_TEXT = {
+    UNSUPPORTED_MESSAGE_TYPE: 'Unsupported message type',
+    APPLICATION_INTERNAL_ERROR: 'Application internal error',
+}
+
+# Same layout hl7apy's Message("ACK").to_mllp() produced, with the sender's applications
+# and facilities mirrored: MSH-3/4 answer from the original MSH-5/6 and MSH-5/6 go back to MSH-3/4
+_ACK = "\x0bMSH|^~\\&|{5}|{6}|{3}|{4}|{0}||ACK|{1}||2.5\rMSA|{2}|{7}\r"
+_ERR = "ERR|||{0}^{1}^HL70357|E||||{2}\r"
+_MLLP_END = "\x1c\r"
+_ACK_MSH_KEYS = ('sending_application', 'sending_facility', 'receiving_application', 'receiving_facility',
+                 'message_control_id')
+_ACK_ENCODING = '|^~\\&'  # MSH-1 and MSH-2 of the ACK
+_ESCAPES = {'|': '\\F\\', '^': '\\S\\', '~': '\\R\\', '\\': '\\E\\', '&': '\\T\\'}
+_timestamp = (0, '')
+
+def _message_timestamp():
+    # MSH-7 only changes once a second, so format it once a second
+    global _timestamp
+    second = int(time.time())
+    if _timestamp[0] != second:
+        _timestamp = (second, datetime.fromtimestamp(second).strftime('%Y%m%d%H%M%S'))
+    return _timestamp[1]
+
+@lru_cache(maxsize=16)
+def _reencoding_table(encoding):
+    # The sender's separators become the ACK's, and the ACK's separators written as data get escaped
+    table = {ord(char): _ESCAPES[char] for char in _ACK_ENCODING}
+    table.update((ord(char), ack_char) for char, ack_char in zip(encoding, _ACK_ENCODING))
+    return table
+
+def _ack_fields(incoming_message):
+    # MSH-3, 4, 5, 6 and 10 of the acknowledged message, parsed or raw ER7, as ER7 text of the ACK's encoding
+    if incoming_message is None:
+        return ('',) * 5
+    if isinstance(incoming_message, str):
+        msh = incoming_message.lstrip().split('\r', 1)[0]
+        fields = msh.split(msh[3:4] or '|')
+        encoding = msh[3:8]
+        fields = tuple(fields[n] if n < len(fields) else '' for n in (2, 3, 4, 5, 9))
+    else:
+        msh = incoming_message.get('msh')
+        if msh is None:
+            return ('',) * 5
+        encoding = (msh.get('field_separator') or '|') + (msh.get('encoding_characters') or '^~\\&')
+        fields = tuple(msh.get(key) or '' for key in _ACK_MSH_KEYS)
+    if encoding[:5] == _ACK_ENCODING or len(encoding) < 5:
+        return fields
+    table = _reencoding_table(encoding[:5])
+    return tuple(field.translate(table) for field in fields)
+
+def create_ack_response(incoming_message, code='AA', error_msg=None, error_code=APPLICATION_INTERNAL_ERROR):
+    """MLLP-framed ACK (AA), or AE/AR with an ERR segment, for a parsed or raw message, as bytes."""
+    started = time.perf_counter()
+    ack = _ACK.format(_message_timestamp(), uuid.uuid4().hex, code, *_ack_fields(incoming_message))
+    if error_msg is not None:
+        ack += _ERR.format(error_code, _ERROR_TEXT.get(error_code, ''), escape(error_msg))
+    ack = (ack + _MLLP_END).encode('utf-8')
+    STAGE_SECONDS.observe(time.perf_counter() - started, stage='ack_build')
+    return ack
+
+def create_error_response(error_msg, incoming_message=None, code='AE', error_code=APPLICATION_INTERNAL_ERROR):
+    logging.warning("Creating error response: %s", Redacted(error_msg))
+    return create_ack_response(incoming_message, code, error_msg, error_code)
 
 def send_message_to_client(message, is_oru = False):
     # Ensure the hl7 message ends with a \r to indicate the end of the message content
     message += '\r'
 
-    logging.info(MLLP_CLIENT_HOST)
-    logging.info(MLLP_CLIENT_PORT)
-    logging.info(MLLP_CLIENT_ORU_PORT)
+    port = MLLP_CLIENT_ORU_PORT if is_oru else MLLP_CLIENT_PORT
+    OUTBOUND_LOG.debug("Sending response to %s:%s", MLLP_CLIENT_HOST, port)
 
-    if is_oru:
-        client = MLLPClient(MLLP_CLIENT_HOST, MLLP_CLIENT_ORU_PORT)
-    else:
-        client = MLLPClient(MLLP_CLIENT_HOST, MLLP_CLIENT_PORT)
-    
-    client.send_message(message)
+    if MLLP_PIPELINE_DEPTH > 1:
+        # Don't wait for the ACK, the pipeline keeps up to MLLP_PIPELINE_DEPTH messages in flight
+        try:
+            future = get_pipeline(MLLP_CLIENT_HOST, port).send(message)
+        except Exception:
+            SEND_FAILURES.inc(port=port)
+            raise
+        future.add_done_callback(lambda future: _log_pipelined_ack(future, port))
+        return
+
+    client = MLLPClient(MLLP_CLIENT_HOST, port)
+    try:
+        client.send_message(message)
+    except Exception:
+        SEND_FAILURES.inc(port=port)
+        raise
+    RESPONSES_SENT.inc(port=port)
     return
 
-def generate_code(letters=2, zeros=3, digits=5):
-    letters_part = ''.join(random.choices(string.ascii_uppercase, k=letters))
-    zeros_part = "0" * zeros  # Create a string of zeros
-    digits_part = ''.join(random.choices(string.digits, k=digits))
-    return f"{letters_part}{zeros_part}{digits_part}"
+def _log_pipelined_ack(future, port):
+    error = future.exception()
+    if error is not None:
+        SEND_FAILURES.inc(port=port)
+        OUTBOUND_LOG.error("Error sending message to client: %s", error)
+    else:
+        RESPONSES_SENT.inc(port=port)
+        OUTBOUND_LOG.info("Received response: %r", future.result())
@@ -0,0 +1,124 @@
+import fcntl
+import json
+import logging
+import math
+import os
+import random
+import string
+import threading
+
+IDENTIFIER_STATE_FILE = os.getenv('IDENTIFIER_STATE_FILE', 'identifiers.json')  # Persisted seed and high-water marks
+IDENTIFIER_BLOCK_SIZE = int(os.getenv('IDENTIFIER_BLOCK_SIZE', '1000'))  # Codes reserved from the state file at a time
+IDENTIFIER_SEED = os.getenv('IDENTIFIER_SEED') or None  # Fixes the code sequence of a fresh state file, random otherwise
+
+
+class CodeFormat:
+    """Codes of ``letters`` upper-case letters, ``zeros`` zeros and ``digits`` digits, e.g. GG000XXXXX.
+
+    Every index below ``size`` maps to a different code.
+    """
+    def __init__(self, letters, zeros, digits):
+        self.letters = letters
+        self.zeros = zeros
+        self.digits = digits
+        self.size = 26 ** letters * 10 ** digits
+
+    def code(self, index):
+        prefix, number = divmod(index, 10 ** self.digits)
+        letters = []
+        for _ in range(self.letters):
+            prefix, letter = divmod(prefix, 26)
+            letters.append(string.ascii_uppercase[letter])
+        return f"{''.join(reversed(letters))}{'0' * self.zeros}{number:0{self.digits}d}"
+
+
+# The IPMS identifiers store_patient generates
+FORMATS = {
+    'mr': CodeFormat(letters=2, zeros=3, digits=5),  # GG000XXXXX
+    'pi': CodeFormat(letters=2, zeros=0, digits=5),  # GGXXXXX
+    'hub': CodeFormat(letters=4, zeros=1, digits=6),  # GGGG0XXXXXX
+    'account': CodeFormat(letters=2, zeros=5, digits=5),  # ZG00000XXXXX
+}
+
+
+class IdentifierAllocator:
+    """Hands out unique codes in the FORMATS layouts.
+
+    Each format numbers its codes 0, 1, 2, ... and maps the n-th through a fixed affine
+    permutation of its code space, so codes look random but can never repeat. The seed
+    behind the permutations and the next unreserved number of each format (the high-water
+    mark) are kept in ``state_file``. Numbers are reserved ``block_size`` at a time under
+    an exclusive lock on the file, so processes sharing it draw from disjoint blocks; the
+    unused rest of a block is skipped after a restart.
+    """
+    def __init__(self, state_file=IDENTIFIER_STATE_FILE, seed=IDENTIFIER_SEED, block_size=IDENTIFIER_BLOCK_SIZE):
+        self.state_file = state_file
+        self.seed = seed
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._blocks = {}  # kind -> (next number, end of the reserved block)
+        self._permutations = {}  # kind -> (multiplier, offset)
+
+    def allocate(self, kind):
+        return self.allocate_many(kind, 1)[0]
+
+    def allocate_many(self, kind, count):
+        code_format = FORMATS[kind]
+        numbers = []
+        with self._lock:
+            while len(numbers) < count:
+                start, end = self._blocks.get(kind, (0, 0))
+                if start == end:
+                    start, end = self._reserve(kind, max(self.block_size, count - len(numbers)))
+                taken = min(end - start, count - len(numbers))
+                numbers.extend(range(start, start + taken))
+                self._blocks[kind] = (start + taken, end)
+            multiplier, offset = self._permutations[kind]
+        return [code_format.code((multiplier * number + offset) % code_format.size) for number in numbers]
+
+    def _reserve(self, kind, count):
+        with open(self.state_file + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            state = self._read_state()
+            if state.get("seed") is None:
+                state["seed"] = self.seed if self.seed is not None else random.SystemRandom().getrandbits(64)
+            elif self.seed is not None and str(state["seed"]) != str(self.seed):
+                # Switching permutations would re-issue codes already handed out
+                logging.warning("Ignoring IDENTIFIER_SEED %s, %s was created with seed %s",
+                                self.seed, self.state_file, state["seed"])
+            self._permutations[kind] = _permutation(state["seed"], kind, FORMATS[kind].size)
+
+            start = state.setdefault("next", {}).get(kind, 0)
+            end = min(start + count, FORMATS[kind].size)
+            if start == end:
+                raise RuntimeError(f"All {FORMATS[kind].size} '{kind}' identifiers have been allocated")
+            state["next"][kind] = end
+            self._write_state(state)
+        return start, end
+
+    def _read_state(self):
+        try:
+            with open(self.state_file, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _write_state(self, state):
+        tmp_file = self.state_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.state_file)
+
+
+def _permutation(seed, kind, size):
+    # x -> (a * x + b) mod size is a bijection whenever a and size are coprime
+    rng = random.Random(f"{seed}:{kind}")
+    while True:
+        multiplier = rng.randrange(1, size)
+        if math.gcd(multiplier, size) == 1:
+            return multiplier, rng.randrange(size)
+
+
+identifier_allocator = IdentifierAllocator()
@@ -0,0 +1,132 @@
+"""Feeds HL7 batch files through the mock's message handlers, without MLLP.
+
+Usage: python ingest.py [--acks acks.hl7] [--send-responses] feed.hl7 [more.hl7 ...]
+
+Input files may be FHS/BHS batches, bare messages one after another, or MLLP captures;
+'-' reads stdin. A message starts at each MSH segment. Files are streamed one segment at
+a time, so memory does not grow with the file size. ACKs are written as an HL7 batch
+(FHS/BHS ... BTS/FTS). The delayed ADT^A04/ORU^R01 responses are not sent unless
+--send-responses is given; the feed is then paused whenever MAX_PENDING_RESPONSES are
+waiting, rather than having the rest refused. The exit status is 1 when any message was
+not answered AA.
+"""
+import argparse
+import collections
+import logging
+import sys
+import time
+from contextlib import nullcontext
+
+from scheduler import response_scheduler
+from admission import RESPONSES_PER_MESSAGE
+
+BATCH_SEGMENTS = ('FHS', 'BHS', 'BTS', 'FTS')
+_MLLP_FRAMING = '\x0b\x1c'
+
+
+def read_messages(lines):
+    """Yields ``(message, batch segment)`` pairs: each message as a \\r-joined string, or a batch segment alone."""
+    segments = []
+    for line in lines:
+        segment = line.strip(_MLLP_FRAMING + '\r\n')
+        if segment.startswith('MSH') or segment[:3] in BATCH_SEGMENTS or not segment:
+            if segments:
+                yield '\r'.join(segments), None
+                segments = []
+            if segment[:3] in BATCH_SEGMENTS:
+                yield None, segment
+                continue
+        if segment:
+            segments.append(segment)
+    if segments:
+        yield '\r'.join(segments), None
+
+
+def ack_code(ack):
+    for segment in ack.split('\r'):
+        if segment.startswith('MSA|'):
+            return segment.split('|')[1]
+    return '?'
+
+
+class AckWriter:
+    """Writes ACKs as one batch: FHS/BHS, a message per ACK (segments on their own lines), BTS/FTS."""
+    def __init__(self, f):
+        self.f = f
+        self.count = 0
+        timestamp = time.strftime('%Y%m%d%H%M%S')
+        f.write(f"FHS|^~\\&|||||{timestamp}\nBHS|^~\\&|||||{timestamp}\n")
+
+    def write(self, ack):
+        self.f.write(ack.replace('\r', '\n'))
+        self.f.write('\n')
+        self.count += 1
+
+    def close(self):
+        self.f.write(f"BTS|{self.count}\nFTS|1\n")
+
+
+def wait_for_scheduler(headroom=RESPONSES_PER_MESSAGE):
+    # Room for the slots admission control reserves per message, so it does not refuse the message
+    while response_scheduler.pending() + headroom > response_scheduler.max_pending:
+        time.sleep(0.05)
+
+
+def ingest(paths, ack_file=None, progress=10000, encoding='utf-8'):
+    """Handles every message in ``paths``; returns the number of messages per ACK code and the seconds taken."""
+    # Imported here: server opens the DataStore and configures logging on import, which --help must not do
+    from server import HL7Handler, datastore
+
+    codes = collections.Counter()
+    writer = AckWriter(ack_file) if ack_file is not None else None
+    started = time.perf_counter()
+    for path in paths:
+        with nullcontext(sys.stdin) if path == '-' else open(path, encoding=encoding, errors='replace') as f:
+            for message, batch_segment in read_messages(f):
+                if message is None:
+                    if batch_segment.startswith('BTS'):
+                        count = batch_segment.split('|')[1:2]
+                        logging.info("End of batch in %s, %s messages announced", path, count[0] if count else '?')
+                    continue
+                if not response_scheduler.discard:
+                    wait_for_scheduler()
+                ack = HL7Handler(message).reply()
+                ack = ack.decode('utf-8').strip(_MLLP_FRAMING + '\r')
+                codes[ack_code(ack)] += 1
+                if writer is not None:
+                    writer.write(ack)
+                handled = sum(codes.values())
+                if progress and handled % progress == 0:
+                    elapsed = time.perf_counter() - started
+                    print(f"{handled} messages in {elapsed:.1f} s, {handled / elapsed:.0f} msg/s", file=sys.stderr)
+    if writer is not None:
+        writer.close()
+    datastore.flush()
+    return codes, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='+', help="HL7 files, '-' for stdin")
+    parser.add_argument('--acks', help="write the ACKs to this file")
+    parser.add_argument('--encoding', default='utf-8')
+    parser.add_argument('--progress', type=int, default=10000, help="report every N messages, 0 to disable")
+    parser.add_argument('--send-responses', action='store_true',
+                        help="send the delayed ADT^A04/ORU^R01 responses and wait for them before exiting")
+    args = parser.parse_args()
+
+    response_scheduler.discard = not args.send_responses
+    with open(args.acks, 'w', encoding='utf-8') if args.acks else nullcontext() as ack_file:
+        codes, elapsed = ingest(args.files, ack_file, args.progress, args.encoding)
+    handled = sum(codes.values())
+    print(f"{handled} messages in {elapsed:.2f} s, {handled / elapsed if elapsed else 0:.1f} msg/s")
+    print("ACK codes: " + ', '.join(f"{code} {count}" for code, count in sorted(codes.items())))
+
+    if args.send_responses:
+        while response_scheduler.pending():
+            time.sleep(0.5)
+    return 1 if handled > codes['AA'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
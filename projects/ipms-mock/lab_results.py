@@ -0,0 +1,146 @@
+import json
+import logging
+import os
+import random
+import re
+
+LAB_DICTIONARY_DIR = os.getenv('LAB_DICTIONARY_DIR', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'ipms-dictionaries', 'ipms-mnemonics', 'output'))  # Extracted IPMS dictionaries
+LAB_DICTIONARY_FILES = ('LAB_TEST_DICT.json', 'BBK_TEST_DICT.json', 'MIC_PROCEDURE_DICT.json')
+ABNORMAL_RESULT_RATE = float(os.getenv('ABNORMAL_RESULT_RATE', '0.15'))  # Share of numeric results outside NOR-LO/NOR-HI
+
+# Result of orders whose test is not in the dictionaries, as IPMS always answered before
+DEFAULT_OBSERVATION = {'value_type': 'ST', 'identifier': 'CD4^CD4 count', 'value': '450', 'units': 'cells/mm3',
+                       'range': '200-1500', 'flag': 'N'}
+
+_NUMBER = re.compile(r'-?\d+(?:\.\d+)?\Z')
+_RANGE = re.compile(r'\s*(-?\d+(?:\.\d+)?)\s*-\s*(-?\d+(?:\.\d+)?)')
+_PRINT_NUMBER = re.compile(r'\d+\.\d+\Z')
+_WORD = re.compile(r'\w')
+
+_random = random.Random()
+
+
+class LabTest:
+    """One dictionary entry, reduced to what an OBX needs.
+
+    A test is numeric (``low``/``high`` from NOR-LO/NOR-HI or the reference range), coded
+    (its RESULT CODES), or free text. A profile lists the tests of its ``components``.
+    """
+    def __init__(self, mnemonic, name, department):
+        self.mnemonic = mnemonic
+        self.name = name
+        self.department = department
+        self.units = ''
+        self.low = self.high = None
+        self.range = ''
+        self.decimals = 0
+        self.codes = []
+        self.component_mnemonics = []
+        self.components = []  # LabTests, resolved once every dictionary is loaded
+
+    def observation(self):
+        identifier = f"{self.mnemonic}^{self.name}"
+        if self.low is not None:
+            value = self._numeric_value()
+            flag = 'L' if value < self.low else 'H' if value > self.high else 'N'
+            return {'value_type': 'NM', 'identifier': identifier, 'value': f"{value:.{self.decimals}f}",
+                    'units': self.units, 'range': self.range, 'flag': flag}
+        if self.codes:
+            code, text = _random.choice(self.codes)
+            return {'value_type': 'CE', 'identifier': identifier, 'value': f"{code}^{text}", 'units': self.units,
+                    'range': '', 'flag': ''}
+        text = 'No growth' if self.department.startswith('M') else 'Normal'
+        return {'value_type': 'ST', 'identifier': identifier, 'value': text, 'units': self.units, 'range': '',
+                'flag': ''}
+
+    def _numeric_value(self):
+        # Abnormal values land 5-50% of the range width outside it; nothing below 0 for non-negative ranges
+        width = self.high - self.low
+        value = self.low + width * _random.random()
+        if _random.random() < ABNORMAL_RESULT_RATE:
+            if self.low > 0 and _random.random() < 0.5:
+                value = max(self.low - width * _random.uniform(0.05, 0.5), 0)
+            else:
+                value = self.high + width * _random.uniform(0.05, 0.5)
+        # Flag the value as reported, after rounding to the test's decimals
+        return round(value, self.decimals)
+
+    def observations(self):
+        """OBX values of the test, or of each component for a profile."""
+        if self.components:
+            return [component.observation() for component in self.components]
+        return [self.observation()]
+
+
+def _rows(entry):
+    # The result group tables, extracted as {row number: {column: value}}
+    for key, table in entry.items():
+        if key.startswith('RES GRP') and isinstance(table, dict):
+            yield from (row for row in table.values() if isinstance(row, dict))
+
+
+def _lab_test(entry):
+    test = LabTest(entry['MNEMONIC'].strip(), entry.get('NAME', '').strip(), entry.get('DEPARTMENT', ''))
+    # The tables were extracted from column-aligned text, so only keep values that look right
+    for row in _rows(entry):
+        units = row.get('UNITS', '').strip()
+        if not test.units and units not in ('', 'Y', 'N'):
+            test.units = units
+        low, high = row.get('NOR-LO', '').strip(), row.get('NOR-HI', '').strip()
+        if not (_NUMBER.match(low) and _NUMBER.match(high)):
+            reference = _RANGE.match(row.get('REF RANGE') or row.get('REFERENCE') or '')
+            if reference is None:
+                continue
+            low, high = reference.groups()
+        if test.low is None and float(low) < float(high):
+            test.low, test.high, test.range = float(low), float(high), f"{low}-{high}"
+            decimals = row.get('DEC', '').strip()
+            test.decimals = int(decimals) if decimals.isdigit() else max(
+                len(value.partition('.')[2]) for value in (low, high))
+    for code in (entry.get('#') or {}).get('RESULT CODES') or []:
+        number, _, text = code.strip().partition(' ')
+        text = text.strip()
+        if _WORD.search(number) and _WORD.search(text):  # Extraction leftovers like '.' are not result codes
+            test.codes.append((number, text))
+    for row in (entry.get('COMPONENTS') or {}).values():
+        component = (row.get('COMPONENTS') or row.get('COMPONENT') or '').split()
+        if row.get('PROFILE', '').startswith('DEFAULT') or not component:
+            continue
+        # "2820.0000 BABO Patient ABO Grouping": print number, mnemonic, name
+        test.component_mnemonics.append(component[1] if _PRINT_NUMBER.match(component[0]) and len(component) > 1
+                                        else component[0])
+    return test
+
+
+def load_lab_tests(directory=LAB_DICTIONARY_DIR, files=LAB_DICTIONARY_FILES):
+    """Index of the dictionary tests by mnemonic, with profile components resolved."""
+    tests = {}
+    for name in files:
+        path = os.path.join(directory, name)
+        try:
+            with open(path) as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            logging.info("Lab dictionary %s not found, its tests get the default result", path)
+            continue
+        for entry in entries:
+            if entry.get('MNEMONIC'):
+                test = _lab_test(entry)
+                tests.setdefault(test.mnemonic, test)
+    for test in tests.values():
+        test.components = [tests[mnemonic] for mnemonic in test.component_mnemonics
+                           if mnemonic in tests and mnemonic != test.mnemonic]
+    logging.info("Loaded %s lab tests from %s", len(tests), directory)
+    return tests
+
+
+lab_tests = load_lab_tests()
+
+
+def observations(universal_service_identifier):
+    """OBX values for the test ordered in OBR-4 (mnemonic^name), by one index lookup."""
+    test = lab_tests.get(universal_service_identifier.split('^', 1)[0])
+    if test is None:
+        return [DEFAULT_OBSERVATION]
+    return test.observations()
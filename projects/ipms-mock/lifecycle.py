@@ -0,0 +1,154 @@
+import glob
+import importlib
+import json
+import logging
+import os
+import signal
+import socket
+import subprocess
+import time
+from collections.abc import Mapping
+
+from scheduler import SchedulerFull
+
+LISTEN_FD = os.getenv('LISTEN_FD')  # Listening socket inherited from app.py, the server binds its own without it
+LISTEN_BACKLOG = int(os.getenv('LISTEN_BACKLOG', '1024'))  # Connections the kernel queues for the server
+SERVER_REUSE_PORT = os.getenv('SERVER_REUSE_PORT', '0') == '1'  # Bind with SO_REUSEPORT, set for --workers processes
+READY_FD = os.getenv('READY_FD')  # Pipe on which app.py waits for the server to be up
+TAKEOVER_FD = os.getenv('TAKEOVER_FD')  # Pipe on which app.py lets the server start once the one it replaces stopped
+PENDING_RESPONSES_DIR = os.getenv('PENDING_RESPONSES_DIR', 'pending-responses')  # Responses handed to the next server
+SERVER_DRAIN_TIMEOUT = float(os.getenv('SERVER_DRAIN_TIMEOUT', '15'))  # Seconds open connections get on shutdown
+
+
+def listening_socket(host, port):
+    """The socket passed by app.py, one bound with SO_REUSEPORT for --workers, or None to let the engine bind."""
+    if LISTEN_FD is not None:
+        return socket.socket(fileno=int(LISTEN_FD))
+    if not SERVER_REUSE_PORT:
+        return None
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(LISTEN_BACKLOG)
+    return sock
+
+
+def run_workers(count, args, env, metrics_port=0):
+    """Runs ``count`` server processes (``args``) on SO_REUSEPORT sockets of the same port until SIGTERM/SIGINT.
+
+    The kernel spreads new connections over the processes. Each one gets metrics port
+    ``metrics_port + index`` when metrics are on. Returns the highest exit code.
+    """
+    env = dict(os.environ, **env, SERVER_WORKERS='1', SERVER_REUSE_PORT='1')
+    processes = []
+    for index in range(count):
+        if metrics_port:
+            env['METRICS_PORT'] = str(metrics_port + index)
+        # Own session: Ctrl-C reaches this process only, which stops the workers gracefully
+        processes.append(subprocess.Popen(args, env=env, start_new_session=True))
+    logging.info("Started %s workers: %s", count, ', '.join(str(process.pid) for process in processes))
+
+    def _stop(signum, frame):
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+    for process in processes:
+        if process.wait():
+            logging.error("Worker %s exited with code %s", process.pid, process.returncode)
+    return max(process.returncode for process in processes)
+
+
+def notify_ready():
+    if READY_FD is not None:
+        fd = int(READY_FD)
+        os.write(fd, b'R')
+        os.close(fd)
+
+
+def wait_for_takeover():
+    """Blocks until app.py has stopped the server this one replaces; False when not started by app.py."""
+    if TAKEOVER_FD is None:
+        return False
+    fd = int(TAKEOVER_FD)
+    os.read(fd, 1)  # Also returns if app.py is gone
+    os.close(fd)
+    return True
+
+
+def _plain(value):
+    # Parsed messages (ER7Message/ER7Segment) become the dicts a full parse would give
+    if isinstance(value, Mapping):
+        return {key: _plain(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_plain(item) for item in value]
+    return value
+
+
+def _write_records(path, records):
+    with open(path + ".tmp", "w") as f:
+        json.dump(records, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def save_pending_responses(responses, directory=PENDING_RESPONSES_DIR):
+    """Writes ``(due time, callback, args)`` entries from ResponseScheduler.stop for the next server."""
+    if not responses:
+        return
+    records = [{'due': due, 'callback': f"{callback.__module__}:{callback.__qualname__}", 'args': _plain(list(args))}
+               for due, callback, args in responses]
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{os.getpid()}.json")
+    _write_records(path, records)
+    logging.info("Saved %s pending responses to %s", len(records), path)
+
+
+def _callback(name):
+    module, qualname = name.split(':')
+    callback = importlib.import_module(module)
+    for part in qualname.split('.'):
+        callback = getattr(callback, part)
+    return callback
+
+
+def adopt_pending_responses(scheduler, directory=PENDING_RESPONSES_DIR):
+    """Schedules the responses a previous server saved, each at its original due time.
+
+    Malformed records are logged and skipped. When the scheduler is full, the records not
+    scheduled yet go back to the pending file for the next server.
+    """
+    for path in sorted(glob.glob(os.path.join(directory, '*.json'))):
+        claimed = f"{path}.{os.getpid()}"
+        try:
+            os.rename(path, claimed)  # Only one server gets each file
+        except FileNotFoundError:
+            continue
+        try:
+            with open(claimed) as f:
+                records = json.load(f)
+            if not isinstance(records, list):
+                raise ValueError("not a list of responses")
+        except (OSError, ValueError) as e:
+            logging.error("Could not read pending responses from %s, left as %s: %s", path, claimed, e)
+            continue
+        now = time.time()
+        adopted = 0
+        for index, record in enumerate(records):
+            try:
+                callback, due, args = _callback(record['callback']), float(record['due']), list(record['args'])
+            except (KeyError, TypeError, ValueError, ImportError, AttributeError) as e:
+                logging.error("Skipping malformed pending response %s in %s: %r", index, path, e)
+                continue
+            try:
+                scheduler.schedule(max(due - now, 0), callback, *args)
+            except SchedulerFull:
+                _write_records(path, records[index:])
+                logging.warning("Scheduler full, left %s pending responses in %s", len(records) - index, path)
+                break
+            adopted += 1
+        os.remove(claimed)
+        logging.info("Adopted %s pending responses from %s", adopted, path)
@@ -0,0 +1,132 @@
+import atexit
+import logging
+import os
+import queue
+import random
+import re
+from collections.abc import Mapping
+from logging.handlers import QueueHandler, QueueListener
+
+from metrics import Counter, registry
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))  # Records waiting for the writer thread, more are dropped
+LOG_SAMPLING = os.getenv('LOG_SAMPLING', '')  # Share of records kept per logger, e.g. 'ipms.message=0.01'
+LOG_REDACT = os.getenv('LOG_REDACT', '1') == '1'  # Mask patient data in the log output
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+MESSAGE_LOG = logging.getLogger('ipms.message')  # Contents of inbound messages
+OUTBOUND_LOG = logging.getLogger('ipms.outbound')  # Responses sent to the MLLP listeners and their ACKs
+
+DROPPED_RECORDS = registry.register(Counter(
+    'ipms_log_records_dropped_total', 'Log records dropped because the log queue was full'))
+
+MASK = '***'
+_SEGMENT_SEPARATOR = re.compile(r'\r\n|\r|\n')
+_IDENTIFIER = re.compile(r'\b(?=[\w-]*\d)[\w-]{5,}\b')  # Omang, MR, PI, HUB and account numbers
+
+
+class Redacted:
+    """Log argument whose patient data is masked when (and only if) the record is formatted.
+
+    ER7 text is shown one segment per line with every PID field after PID-1 masked, a parsed
+    message with all its ``pid`` values masked, and anything else with identifier-like words
+    (5+ characters including a digit) masked. With ``LOG_REDACT=0`` values are shown as is.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        value = self.value
+        if isinstance(value, str) and value.startswith('MSH'):
+            segments = _SEGMENT_SEPARATOR.split(value)
+            return '\n'.join(_redact_segment(segment) if LOG_REDACT else segment for segment in segments)
+        if not LOG_REDACT:
+            return str(value)
+        if isinstance(value, dict):
+            return repr({key: _redact_pid(segment) if key == 'pid' else segment for key, segment in value.items()})
+        if isinstance(value, Mapping):
+            return repr(value)  # ER7Message only shows MSH
+        return _IDENTIFIER.sub(MASK, str(value))
+
+
+def _redact_segment(segment):
+    if not segment.startswith('PID') or len(segment) < 4:
+        return segment
+    separator = segment[3]
+    fields = segment.split(separator)
+    return separator.join(fields[:2] + [MASK if field else '' for field in fields[2:]])
+
+
+def _redact_pid(segment):
+    if not isinstance(segment, Mapping):
+        return MASK
+    return {key: MASK for key in segment}
+
+
+class _SamplingFilter(logging.Filter):
+    """Keeps a share of the records of each logger named in ``rates`` (children included)."""
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        name = record.name
+        while True:
+            rate = self.rates.get(name)
+            if rate is not None:
+                return rate >= 1 or random.random() < rate
+            if '.' not in name:
+                return True
+            name = name.rsplit('.', 1)[0]
+
+
+class _NonBlockingQueueHandler(QueueHandler):
+    """Hands records to the writer thread unformatted, and drops them when the queue is full."""
+    def prepare(self, record):
+        # Message and arguments are formatted by the writer; tracebacks cannot wait
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DROPPED_RECORDS.inc()
+
+
+def parse_sampling(spec):
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, rate = item.partition('=')
+        rates[name.strip()] = float(rate)
+    return rates
+
+
+def configure_logging(level=LOG_LEVEL, queue_size=LOG_QUEUE_SIZE, sampling=LOG_SAMPLING):
+    """Routes the root logger through a bounded queue to a writer thread that formats and writes to stderr.
+
+    Logging threads only create the record and queue it; they never wait for the writer.
+    """
+    records = queue.Queue(queue_size)
+    handler = _NonBlockingQueueHandler(records)
+    rates = parse_sampling(sampling)
+    if rates:
+        handler.addFilter(_SamplingFilter(rates))
+
+    writer = logging.StreamHandler()
+    writer.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = QueueListener(records, writer)
+    listener.start()
+    atexit.register(listener.stop)  # Writes what is still queued
+
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+    return listener
@@ -0,0 +1,194 @@
+import bisect
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))  # Port of the Prometheus /metrics endpoint, 0 disables it
+METRICS_HOST = os.getenv('METRICS_HOST', '0.0.0.0')
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [(self.name, _labels(self.labelnames, key), value) for key, value in values]
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}  # labels -> [count per bucket..., count above the last bucket, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, list(counts)) for key, counts in self._values.items())
+        samples = []
+        names = self.labelnames + ('le',)
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                samples.append((self.name + '_bucket', _labels(names, key + (bound,)), cumulative))
+            samples.append((self.name + '_sum', _labels(self.labelnames, key), counts[-1]))
+            samples.append((self.name + '_count', _labels(self.labelnames, key), cumulative))
+        return samples
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+class Gauge:
+    """A value read from ``function`` at scrape time."""
+    def __init__(self, name, documentation, function):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+
+    def samples(self):
+        return [(self.name, '', self.function())]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        """Every metric in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            kind = {Counter: 'counter', Histogram: 'histogram', Gauge: 'gauge'}[type(metric)]
+            try:
+                samples = metric.samples()
+            except Exception:
+                logging.exception("Error collecting metric %s", metric.name)
+                continue
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {kind}")
+            lines.extend(f"{name}{labels} {value}" for name, labels, value in samples)
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+MESSAGES = registry.register(Counter(
+    'ipms_messages_total', 'Inbound messages by type and ACK code (none when the connection was closed)',
+    ('message_type', 'ack_code')))
+STAGE_SECONDS = registry.register(Histogram(
+    'ipms_stage_duration_seconds', 'Time spent parsing, handling (ACK included) and building ACKs', ('stage',)))
+RESPONSES_SENT = registry.register(Counter(
+    'ipms_responses_sent_total', 'ADT^A04/ORU^R01 responses acknowledged by the listener', ('port',)))
+SEND_FAILURES = registry.register(Counter(
+    'ipms_outbound_send_failures_total', 'ADT^A04/ORU^R01 responses that could not be delivered', ('port',)))
+
+
+def gauge(name, documentation, function):
+    return registry.register(Gauge(name, documentation, function))
+
+
+_actions = {}  # POST path -> function of the query parameters, returning the response text
+
+
+def action(path, function):
+    """Serves ``function`` on POST ``path`` of the metrics endpoint; ValueError answers 400."""
+    _actions[path] = function
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        function = _actions.get(url.path)
+        if function is None:
+            self.send_error(404)
+            return
+        try:
+            status, text = 200, function(**dict(parse_qsl(url.query)))
+        except (TypeError, ValueError, RuntimeError) as e:
+            status, text = 400, str(e)
+        body = (text + '\n').encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes would flood the DEBUG log
+
+
+def start_http_server(port=METRICS_PORT, host=METRICS_HOST):
+    """Serves GET /metrics and the POST actions from a daemon thread."""
+    server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    logging.info("Serving metrics on http://%s:%s/metrics", host, port)
+    return server
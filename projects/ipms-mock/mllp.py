@@ -0,0 +1,81 @@
+START_BLOCK = b"\x0b"
+END_BLOCK = b"\x1c\x0d"  # File separator followed by a carriage return
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+class MLLPFramingError(Exception):
+    pass
+
+
+def encode_frame(message, encoding='utf-8'):
+    if isinstance(message, str):
+        message = message.encode(encoding)
+    return START_BLOCK + message + END_BLOCK
+
+
+class MLLPFrameDecoder:
+    """Incremental MLLP decoder for a byte stream read in arbitrary chunks.
+
+    ``feed`` buffers partial frames across calls and returns the payload of every frame
+    completed so far. Bytes outside a frame (such as the extra CR some peers send after
+    the end block) are discarded.
+    """
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray()
+        self._scanned = 0  # Offset up to which the buffer is known not to contain END_BLOCK
+
+    def feed(self, data):
+        self._buffer += data
+        frames = []
+        while True:
+            start = self._buffer.find(START_BLOCK)
+            if start == -1:
+                self._buffer.clear()
+                self._scanned = 0
+                break
+            if start:
+                del self._buffer[:start]
+                self._scanned = max(self._scanned - start, 0)
+
+            end = self._buffer.find(END_BLOCK, max(self._scanned, 1))
+            if end == -1:
+                # END_BLOCK may straddle chunks, so rescan its first byte next time
+                self._scanned = max(len(self._buffer) - 1, 1)
+                if len(self._buffer) > self.max_frame_size:
+                    raise MLLPFramingError(f"MLLP frame exceeds {self.max_frame_size} bytes")
+                break
+
+            frames.append(bytes(self._buffer[1:end]))
+            del self._buffer[:end + len(END_BLOCK)]
+            self._scanned = 0
+        return frames
+
+    @property
+    def buffered(self):
+        """Number of bytes of an incomplete frame held in the buffer."""
+        return len(self._buffer)
+
+
+def _field(message, segment_name, index):
+    # Works on framed or bare ER7, str or bytes; the field separator is the 4th character of MSH
+    if isinstance(message, bytes):
+        message = message.decode('utf-8', 'replace')
+    message = message.lstrip('\x0b')
+    field_sep = message[3:4] or '|'
+    for segment in message.replace('\n', '\r').split('\r'):
+        if segment.startswith(segment_name):
+            fields = segment.split(field_sep)
+            return fields[index] if index < len(fields) else None
+    return None
+
+
+def message_control_id(message):
+    """MSH-10 of an ER7 message."""
+    # MSH-1 is the separator itself, so MSH-10 is the 9th element after splitting
+    return _field(message, 'MSH', 9)
+
+
+def acknowledged_control_id(ack):
+    """MSA-2 of an ACK, i.e. the MSH-10 of the message it acknowledges."""
+    return _field(ack, 'MSA', 2)
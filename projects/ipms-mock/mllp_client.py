@@ -1,22 +1,252 @@
 import logging
+import os
 import socket
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+
+from log_config import OUTBOUND_LOG
+from mllp import MLLPFrameDecoder, acknowledged_control_id, message_control_id
+
+MLLP_POOL_SIZE = int(os.getenv('MLLP_POOL_SIZE', '8'))  # Idle connections kept per (host, port)
+MLLP_POOL_IDLE_TIMEOUT = float(os.getenv('MLLP_POOL_IDLE_TIMEOUT', '60'))  # Seconds before an idle connection is dropped
+MLLP_CLIENT_TIMEOUT = float(os.getenv('MLLP_CLIENT_TIMEOUT', '30'))  # Connect/ACK timeout in seconds
+MLLP_PIPELINE_DEPTH = int(os.getenv('MLLP_PIPELINE_DEPTH', '1'))  # Messages in flight per connection, 1 disables pipelining
+
+
+class MLLPConnectionPool:
+    """Thread-safe pool of persistent connections to one MLLP listener.
+
+    Connections are handed out one caller at a time and returned after the ACK has been
+    read. Idle connections older than ``idle_timeout`` or closed by the peer are dropped
+    and replaced with a fresh connection on the next ``acquire``.
+    """
+    def __init__(self, host, port, size=MLLP_POOL_SIZE, idle_timeout=MLLP_POOL_IDLE_TIMEOUT,
+                 timeout=MLLP_CLIENT_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = deque()  # (socket, time it was released)
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Returns ``(sock, reused)``, reusing an idle connection when a live one is available."""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                sock, released = self._idle.pop()
+            if time.monotonic() - released < self.idle_timeout and _is_alive(sock):
+                return sock, True
+            sock.close()
+        return self._connect(), False
+
+    def release(self, sock):
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((sock, time.monotonic()))
+                return
+        sock.close()
+
+    def discard(self, sock):
+        sock.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, deque()
+        for sock, _ in idle:
+            sock.close()
+
+    def _connect(self):
+        logging.info("Opening MLLP connection to %s:%s", self.host, self.port)
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+
+def _is_alive(sock):
+    # An idle connection should have nothing to read: EOF or stray bytes both mean it is unusable
+    try:
+        sock.setblocking(False)
+        try:
+            return not sock.recv(1, socket.MSG_PEEK)
+        finally:
+            sock.setblocking(True)
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(host, port):
+    with _pools_lock:
+        pool = _pools.get((host, port))
+        if pool is None:
+            pool = _pools[(host, port)] = MLLPConnectionPool(host, port)
+        return pool
+
 
 class MLLPClient:
     def __init__(self, host, port):
         self.host = host
         self.port = port
+        self.pool = get_pool(host, port)
+
+    def send_message(self, message):
+        data = message.encode('UTF-8')
+        while True:
+            sock, reused = self.pool.acquire()
+            decoder = MLLPFrameDecoder()
+            sent = received = closed = False
+            try:
+                sock.settimeout(self.pool.timeout)
+                sock.sendall(data)
+                sent = True
+                frames = []
+                while not frames:
+                    chunk = sock.recv(65536)
+                    if not chunk:
+                        closed = True
+                        raise ConnectionError(f"MLLP connection to {self.host}:{self.port} closed before the ACK")
+                    received = True
+                    frames = decoder.feed(chunk)
+            except OSError as e:
+                self.pool.discard(sock)
+                # A pooled connection the listener dropped in the meantime fails on send, or is closed
+                # or reset before anything comes back. Anything else (e.g. an ACK timeout) may follow a
+                # delivered message, and sending it again would duplicate it
+                stale = not sent or (not received and (closed or isinstance(e, ConnectionResetError)))
+                if reused and stale:
+                    logging.info("Stale MLLP connection to %s:%s, reconnecting", self.host, self.port)
+                    continue
+                raise
+
+            if len(frames) == 1 and not decoder.buffered:
+                self.pool.release(sock)
+            else:
+                # Unexpected extra data would be mistaken for the next message's ACK
+                self.pool.discard(sock)
+            ack = frames[0]
+            OUTBOUND_LOG.info("Received response: %r", ack)
+            return ack
+
+
+class PipelinedMLLPConnection:
+    """One persistent connection to an MLLP listener with up to ``depth`` messages in flight.
+
+    ``send`` writes the message and returns a Future resolved with the ACK payload. A reader
+    thread decodes ACK frames and matches them to the in-flight message whose MSH-10 equals
+    the ACK's MSA-2; ACKs without a known MSA-2 resolve the oldest message, since MLLP
+    listeners answer in order. If the connection drops or no ACK arrives within
+    ``timeout`` every in-flight message fails and the next send reconnects.
+    """
+    def __init__(self, host, port, depth=MLLP_PIPELINE_DEPTH, timeout=MLLP_CLIENT_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.depth = depth
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(depth)
+        self._lock = threading.Lock()  # Guards the socket and the in-flight table
+        self._send_lock = threading.Lock()
+        self._sock = None
+        self._in_flight = OrderedDict()  # sequence -> (control id, Future), oldest first
+        self._sequence = 0
+
+    def send(self, message):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError(f"{self.depth} messages to {self.host}:{self.port} still waiting for an ACK")
+        future = Future()
+        future.add_done_callback(lambda _: self._slots.release())
+        data = message.encode('UTF-8')
+        # Register and write under one lock so the in-flight order is the order on the wire
+        with self._send_lock:
+            try:
+                with self._lock:
+                    sock = self._connect()
+                    self._sequence += 1
+                    self._in_flight[self._sequence] = (message_control_id(message), future)
+            except OSError as e:
+                future.set_exception(e)
+                return future
+            try:
+                sock.sendall(data)
+            except OSError as e:
+                self._fail(sock, e)
+        return future
 
     def send_message(self, message):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        return self.send(message).result(self.timeout)
+
+    def close(self):
+        self._fail(None, ConnectionError(f"MLLP connection to {self.host}:{self.port} closed"))
+
+    def _connect(self):
+        if self._sock is None:
+            logging.info("Opening pipelined MLLP connection to %s:%s", self.host, self.port)
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._sock = sock
+            threading.Thread(target=self._read_acks, args=(sock,), daemon=True,
+                             name=f"mllp-acks-{self.host}:{self.port}").start()
+        return self._sock
+
+    def _read_acks(self, sock):
+        decoder = MLLPFrameDecoder()
         try:
-            """Instead of  manually setting the IP each time, use the client's hostname"""
-            
-            logging.info(self.host)
-            logging.info(self.port)
-            sock.connect((self.host, self.port))
-            sock.sendall(message.encode('UTF-8'))
-            received = sock.recv(1024 * 1024)
-            logging.info("Received response: %s", received.decode('UTF-8'))
-            
-        finally:
-            sock.close()
\ No newline at end of file
+            while True:
+                try:
+                    chunk = sock.recv(65536)
+                except socket.timeout:
+                    with self._lock:
+                        if not self._in_flight:
+                            continue  # Idle connection, keep it open
+                    raise TimeoutError(f"No ACK from {self.host}:{self.port} within {self.timeout}s")
+                if not chunk:
+                    raise ConnectionError(f"MLLP connection to {self.host}:{self.port} closed by the listener")
+                for ack in decoder.feed(chunk):
+                    self._resolve(ack)
+        except Exception as e:
+            self._fail(sock, e)
+
+    def _resolve(self, ack):
+        control_id = acknowledged_control_id(ack)
+        with self._lock:
+            match = next((key for key, (expected, _) in self._in_flight.items() if expected == control_id), None)
+            if match is None:
+                if not self._in_flight:
+                    logging.warning("Unsolicited ACK from %s:%s: %s", self.host, self.port, ack)
+                    return
+                match = next(iter(self._in_flight))
+            _, future = self._in_flight.pop(match)
+        future.set_result(ack)
+
+    def _fail(self, sock, error):
+        with self._lock:
+            if sock is not None and sock is not self._sock:
+                return  # Already failed and replaced
+            failed = list(self._in_flight.values())
+            self._in_flight.clear()
+            stale, self._sock = self._sock, None
+        if stale is not None:
+            stale.close()
+        for _, future in failed:
+            if not future.done():
+                future.set_exception(error)
+
+
+_pipelines = {}
+
+
+def get_pipeline(host, port):
+    with _pools_lock:
+        pipeline = _pipelines.get((host, port))
+        if pipeline is None:
+            pipeline = _pipelines[(host, port)] = PipelinedMLLPConnection(host, port)
+        return pipeline
@@ -0,0 +1,96 @@
+"""Times the ACK serializer against the hl7apy ACK it replaced.
+
+For every message of the messages/ corpus it builds the ACK both ways: hl7apy's
+``Message("ACK")`` with ``to_mllp()`` (what ``create_ack_response`` used to do), and
+``helper.create_ack_response``. It checks that hl7apy parses the new ACK, that MSA-2
+echoes MSH-10 and that MSH-3/4/5/6 mirror the sender, then times AA and AE ACKs.
+
+    python perf/bench_ack.py --iterations 2000
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+import uuid
+
+MOCK_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, MOCK_DIR)
+
+from hl7apy.core import Message  # noqa: E402
+from hl7apy.parser import parse_message  # noqa: E402
+
+from bench_parse import load_corpus  # noqa: E402
+from er7 import ER7Message  # noqa: E402
+from helper import create_ack_response, create_error_response  # noqa: E402
+
+
+def hl7apy_ack(incoming_message):
+    response = Message("ACK")
+    response.msh.msh_9 = 'ACK'
+    response.msh.msh_10 = uuid.uuid4().hex
+    response.msa.msa_1 = 'AA'
+    response.msa.msa_2 = incoming_message['msh']['message_control_id']
+    return response.to_mllp().encode('utf-8')
+
+
+def check(name, message, ack):
+    msh = message['msh']
+    parsed = parse_message(ack.decode('utf-8').strip('\x0b\x1c\r'), find_groups=False)
+    expected = {
+        'MSA_2': msh.get('message_control_id', ''),
+        'MSH_3': msh.get('receiving_application', ''),
+        'MSH_4': msh.get('receiving_facility', ''),
+        'MSH_5': msh.get('sending_application', ''),
+        'MSH_6': msh.get('sending_facility', ''),
+    }
+    actual = {
+        'MSA_2': parsed.msa.msa_2.value,
+        'MSH_3': parsed.msh.msh_3.value,
+        'MSH_4': parsed.msh.msh_4.value,
+        'MSH_5': parsed.msh.msh_5.value,
+        'MSH_6': parsed.msh.msh_6.value,
+    }
+    if actual != expected:
+        print(f"MISMATCH {name}: expected {expected}, got {actual}")
+        return False
+    return True
+
+
+def timed(label, iterations, messages, build):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for message in messages:
+            build(message)
+    elapsed = (time.perf_counter() - start) / (iterations * len(messages))
+    print(f"{label:>14}: {elapsed * 1e6:8.1f} us/ACK")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=2000)
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    messages = []
+    failures = 0
+    for name, raw in load_corpus():
+        try:
+            message = ER7Message(raw)
+        except ValueError:
+            continue
+        messages.append(message)
+        failures += not check(name, message, create_ack_response(message))
+        failures += not check(name + ' AE', message, create_error_response("Patient not found | retry", message))
+    print(f"{len(messages)} messages, {failures} mismatches")
+
+    reference = timed('hl7apy', max(args.iterations // 20, 1), messages, hl7apy_ack)
+    fast = timed('serializer AA', args.iterations, messages, create_ack_response)
+    timed('serializer AE', args.iterations, messages, lambda m: create_ack_response(m, 'AE', 'Patient not found'))
+    print(f"speed-up: {reference / fast:.0f}x")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Fills a DataStore backend with synthetic patients and times lookups.
+
+Patients are written in batches like store_patient would produce them, then random keys
+are read back with ``get`` and random MR/HUB identifiers resolved with ``find``. The
+process' peak RSS is reported at the end, so runs with different ``--patients`` counts
+show whether memory grows with the store.
+
+    python perf/bench_datastore.py --mode sqlite --patients 1000000
+"""
+import argparse
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+MOCK_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, MOCK_DIR)
+
+from datastore import DataStore  # noqa: E402
+
+
+def synthetic_patient(n):
+    omang = f"{n:09d}"
+    return omang, {
+        'set_id_pid': '1',
+        'patient_identifier_list': f"GG{n:08d}^^^^MR^GGC~{omang}^^^^SS^GGC~GG{n:05d}^^^^PI^GGC~GG0{n:06d}^^^^HUB^GGC",
+        'patient_name': f"TestPatient{n}^Testing{n}^^^^^F",
+        'date_time_of_birth': '19860420',
+        'administrative_sex': 'F',
+        'ssn_number_patient': omang,
+        'identifiers': {'mr': f"GG{n:08d}", 'pi': f"GG{n:05d}", 'hub': f"GG0{n:06d}"},
+        'patient_account_number': f"ZG{n:010d}",
+    }
+
+
+def timed(label, count, fn):
+    start = time.perf_counter()
+    for _ in range(count):
+        fn()
+    elapsed = time.perf_counter() - start
+    print(f"{label:>8}: {count / elapsed:10.0f}/s  {elapsed / count * 1e6:8.1f} us/op")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', default='sqlite', choices=['json', 'journal', 'sqlite'])
+    parser.add_argument('--patients', type=int, default=100000)
+    parser.add_argument('--lookups', type=int, default=20000)
+    parser.add_argument('--batch', type=int, default=10000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        store = DataStore(os.path.join(tmp, 'data.json'), mode=args.mode)
+        start = time.perf_counter()
+        if hasattr(store.backend, 'set_many'):
+            for first in range(0, args.patients, args.batch):
+                store.backend.set_many(synthetic_patient(n) for n in range(first, min(first + args.batch, args.patients)))
+        else:
+            for n in range(args.patients):
+                store.set(*synthetic_patient(n))
+        print(f"{args.mode}: stored {args.patients} patients in {time.perf_counter() - start:.1f}s")
+
+        rng = random.Random(1)
+        timed('get', args.lookups, lambda: store.get(f"{rng.randrange(args.patients):09d}"))
+        timed('find MR', args.lookups, lambda: store.find('MR', f"GG{rng.randrange(args.patients):08d}"))
+        timed('find HUB', args.lookups, lambda: store.find('HUB', f"GG0{rng.randrange(args.patients):06d}"))
+        timed('set', min(args.lookups, 2000), lambda: store.set(*synthetic_patient(rng.randrange(args.patients))))
+        store.close()
+
+    print(f"peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MiB")
+
+
+if __name__ == '__main__':
+    main()
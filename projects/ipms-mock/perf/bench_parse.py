@@ -0,0 +1,105 @@
+"""Compares the lazy ER7 view with the full hl7apy parse on the messages/ corpus.
+
+For every message it checks that both parsers produce the same segment/field dict, and
+that the lazy view rejects the messages hl7apy cannot parse, including malformed
+variants of the corpus. It then times the work the handlers actually do: parse, read
+MSH-9/MSH-10 and the PID/ORC/OBR fields they use.
+
+    python perf/bench_parse.py --iterations 200
+"""
+import argparse
+import glob
+import logging
+import os
+import sys
+import time
+
+MOCK_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, MOCK_DIR)
+
+from er7 import ER7Message  # noqa: E402
+from server import parse_full_message  # noqa: E402
+
+HANDLER_FIELDS = {
+    'msh': ('message_type', 'message_control_id'),
+    'pid': ('patient_identifier_list', 'ssn_number_patient'),
+    'orc': ('placer_order_number', 'filler_order_number'),
+    'obr': ('universal_service_identifier', 'observation_date_time', 'specimen_source'),
+}
+
+
+def load_corpus():
+    messages = []
+    for path in sorted(glob.glob(os.path.join(MOCK_DIR, 'messages', '*.hl7'))):
+        with open(path) as f:
+            messages.append((os.path.basename(path), f.read().replace('\r\n', '\r').replace('\n', '\r').strip()))
+    return messages
+
+
+def malformed_variants(message):
+    """Copies of a corpus message hl7apy rejects: bad MSH-2, empty or unknown MSH-12, unknown segment."""
+    msh, _, rest = message.partition('\r')
+    fields = msh.split('|')
+    fields += [''] * (12 - len(fields))
+    variants = {'duplicate encoding chars': '|'.join(fields[:1] + ['^^\\&'] + fields[2:]),
+                'unknown segment': msh + '\rXYZ|1'}
+    for label, version in (('empty MSH-12', ''), ('unknown MSH-12', '9.9')):
+        variants[label] = '|'.join(fields[:11] + [version] + fields[12:])
+    return {label: variant + ('\r' + rest if rest and label != 'unknown segment' else '')
+            for label, variant in variants.items()}
+
+
+def rejected(parse, message):
+    try:
+        parse(message)
+    except Exception:
+        return True
+    return False
+
+
+def read_handler_fields(parsed):
+    for segment, keys in HANDLER_FIELDS.items():
+        if segment in parsed:
+            for key in keys:
+                parsed[segment].get(key)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    corpus = []
+    checked = 0
+    for name, message in load_corpus():
+        cases = {name: message}
+        if message.startswith('MSH|'):
+            cases.update((f"{name} ({label})", variant) for label, variant in malformed_variants(message).items())
+        for case, text in cases.items():
+            checked += 1
+            if rejected(parse_full_message, text):
+                if not rejected(ER7Message, text):
+                    print(f"MISMATCH {case}: hl7apy rejects it, the lazy view accepts it")
+                    sys.exit(1)
+                continue
+            expected = parse_full_message(text)
+            actual = ER7Message(text).to_dict()
+            if actual != expected:
+                print(f"MISMATCH {case}\n  hl7apy: {expected}\n  lazy:   {actual}")
+                sys.exit(1)
+            if case == name:
+                corpus.append(text)
+    print(f"{checked} messages parsed or rejected identically, {len(corpus)} corpus messages timed")
+
+    for label, parse in (('strict', parse_full_message), ('lazy', ER7Message)):
+        started = time.perf_counter()
+        for _ in range(args.iterations):
+            for message in corpus:
+                read_handler_fields(parse(message))
+        elapsed = time.perf_counter() - started
+        print(f"{label:>6}: {elapsed / (args.iterations * len(corpus)) * 1e6:9.1f} us/message")
+
+
+if __name__ == '__main__':
+    main()
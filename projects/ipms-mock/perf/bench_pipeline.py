@@ -0,0 +1,80 @@
+"""Outbound throughput of MLLPClient (one message in flight) against pipelined sends.
+
+Runs a local ACK-ing listener that answers frames ``--ack-latency`` seconds after they
+arrive (a stand-in for the network round trip), echoing MSH-10 into MSA-2, then sends the same ORU^R01 messages through both clients.
+
+    python perf/bench_pipeline.py --messages 2000 --depth 32 --ack-latency 0.002
+"""
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+MOCK_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, MOCK_DIR)
+
+from mllp import MLLPFrameDecoder, encode_frame, message_control_id  # noqa: E402
+from mllp_client import MLLPClient, PipelinedMLLPConnection  # noqa: E402
+
+
+def ack_listener(listener, latency):
+    while True:
+        conn, _ = listener.accept()
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        threading.Thread(target=ack_connection, args=(conn, latency), daemon=True).start()
+
+
+def ack_connection(conn, latency):
+    decoder = MLLPFrameDecoder()
+    with conn:
+        while True:
+            chunk = conn.recv(65536)
+            if not chunk:
+                return
+            frames = decoder.feed(chunk)
+            if frames:
+                # Models the round trip: everything that arrived together is ACKed one latency later
+                time.sleep(latency)
+                conn.sendall(b''.join(
+                    encode_frame(f"MSH|^~\\&|||||||ACK|1|P|2.4\rMSA|AA|{message_control_id(frame)}")
+                    for frame in frames))
+
+
+def build_messages(count):
+    return [encode_frame(f"MSH|^~\\&|ADM|LAB|||202405021511||ORU^R01|bench{i}|D|2.4\r"
+                         f"PID|1||{i:09d}^^^^SS^GGC\rOBX|1|ST|ZCD4^CD4||450").decode() + '\r'
+            for i in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--depth', type=int, default=32)
+    parser.add_argument('--ack-latency', type=float, default=0.002)
+    args = parser.parse_args()
+
+    listener = socket.create_server(('127.0.0.1', 0))
+    port = listener.getsockname()[1]
+    threading.Thread(target=ack_listener, args=(listener, args.ack_latency), daemon=True).start()
+    messages = build_messages(args.messages)
+
+    client = MLLPClient('127.0.0.1', port)
+    started = time.perf_counter()
+    for message in messages:
+        client.send_message(message)
+    serial = args.messages / (time.perf_counter() - started)
+
+    pipeline = PipelinedMLLPConnection('127.0.0.1', port, depth=args.depth)
+    started = time.perf_counter()
+    futures = [(message_control_id(message), pipeline.send(message)) for message in messages]
+    mismatched = sum(1 for control_id, future in futures if not future.result().endswith(f"|{control_id}".encode()))
+    pipelined = args.messages / (time.perf_counter() - started)
+
+    print(f"one in flight: {serial:9.1f} msg/s")
+    print(f"pipelined x{args.depth}: {pipelined:9.1f} msg/s ({pipelined / serial:.1f}x), {mismatched} mismatched ACKs")
+
+
+if __name__ == '__main__':
+    main()
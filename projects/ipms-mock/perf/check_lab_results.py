@@ -0,0 +1,100 @@
+"""Check of the ORU^R01 results lab_results generates, on a small fixture dictionary.
+
+The extracted BBK/MIC dictionaries have no numeric ranges, so this builds a LAB_TEST_DICT
+style fixture with NOR-LO/NOR-HI and reference ranges, coded results with extraction
+leftovers, and a profile. It then draws ``--draws`` results per test and requires numeric
+values flagged L/N/H against their range, with both abnormal sides drawn. It also requires
+only clean result codes and the profile expanded into its components. The dictionaries
+in LAB_DICTIONARY_DIR are checked for leftover result codes as well.
+
+    python perf/check_lab_results.py --draws 2000
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+
+MOCK_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, MOCK_DIR)
+
+import lab_results  # noqa: E402
+
+FIXTURE = [
+    {'MNEMONIC': 'HGB', 'NAME': 'Haemoglobin', 'DEPARTMENT': 'HAEM',
+     'RES GRP I': {'1': {'UNITS': 'g/dL', 'DEC': '1', 'NOR-LO': '12.0', 'NOR-HI': '16.0'}}},
+    {'MNEMONIC': 'CRP', 'NAME': 'C-reactive protein', 'DEPARTMENT': 'CHEM',
+     'RES GRP I': {'1': {'UNITS': 'mg/L', 'DEC': '', 'NOR-LO': '0', 'NOR-HI': '5'}}},
+    {'MNEMONIC': 'K', 'NAME': 'Potassium', 'DEPARTMENT': 'CHEM',
+     'RES GRP I': {'1': {'UNITS': 'mmol/L', 'NOR-LO': 'N', 'NOR-HI': '', 'REF RANGE': '3.5 - 5.1'}}},
+    {'MNEMONIC': 'HIVR', 'NAME': 'HIV rapid test', 'DEPARTMENT': 'SERO',
+     '#': {'RESULT CODES': ['1 Negative', '2 Positive', '.', '3 .', '- ']}},
+    {'MNEMONIC': 'LYTES', 'NAME': 'Electrolytes', 'DEPARTMENT': 'CHEM',
+     'COMPONENTS': {'1': {'COMPONENTS': '10.0000 K Potassium'}, '2': {'COMPONENTS': 'CRP'},
+                    '3': {'PROFILE': 'DEFAULT', 'COMPONENTS': 'HGB'}}},
+]
+
+
+def check_numeric(test, draws):
+    problems = []
+    flags = set()
+    for _ in range(draws):
+        result = test.observation()
+        value = float(result['value'])
+        expected = 'L' if value < test.low else 'H' if value > test.high else 'N'
+        flags.add(result['flag'])
+        if result['value_type'] != 'NM' or result['flag'] != expected or result['units'] != test.units:
+            problems.append(f"{test.mnemonic}: {result}")
+        if test.low >= 0 > value:
+            problems.append(f"{test.mnemonic}: negative value {result}")
+    wanted = {'N', 'H'} | ({'L'} if test.low > 0 else set())
+    if flags != wanted:
+        problems.append(f"{test.mnemonic}: flags {sorted(flags)} drawn, expected {sorted(wanted)}")
+    return problems
+
+
+def check_fixture(draws):
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, 'LAB_TEST_DICT.json'), 'w') as f:
+            json.dump(FIXTURE, f)
+        tests = lab_results.load_lab_tests(tmp)
+
+    problems = []
+    for mnemonic, units, low, high, decimals in (('HGB', 'g/dL', 12, 16, 1), ('CRP', 'mg/L', 0, 5, 0),
+                                                  ('K', 'mmol/L', 3.5, 5.1, 1)):
+        test = tests[mnemonic]
+        if (test.units, test.low, test.high, test.decimals) != (units, low, high, decimals):
+            problems.append(f"{mnemonic}: parsed {test.units!r} {test.low}-{test.high} ({test.decimals} decimals)")
+            continue
+        problems += check_numeric(test, draws)
+    if tests['HIVR'].codes != [('1', 'Negative'), ('2', 'Positive')]:
+        problems.append(f"HIVR: result codes {tests['HIVR'].codes}")
+    profile = [result['identifier'] for result in tests['LYTES'].observations()]
+    if profile != ['K^Potassium', 'CRP^C-reactive protein']:
+        problems.append(f"LYTES: components {profile}")
+    return problems
+
+
+def check_dictionaries():
+    return [f"{test.mnemonic}: result code {code!r}" for test in lab_results.lab_tests.values()
+            for code in test.codes if not all(part.strip(' .-') for part in code)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--draws', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+    lab_results._random.seed(args.seed)
+
+    problems = check_fixture(args.draws) + check_dictionaries()
+    for problem in problems:
+        print(problem)
+    print(f"{len(FIXTURE)} fixture tests, {len(lab_results.lab_tests)} dictionary tests, {len(problems)} problems")
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""Golden check: the precompiled ER7 templates against the hl7apy response builders.
+
+Renders the ADT^A04 and ORU^R01 responses for every message of the messages/ corpus
+with both ``create_*_response_message`` (templates) and ``create_*_hl7apy_message``
+(hl7apy tree), with the clock, MSH-10 and the lab results pinned, and requires
+byte-identical output.
+It then does the same for ``--fuzz`` responses whose values are random strings made of
+separators, escape characters, blanks and dates, and times both renderers.
+
+    python perf/check_templates.py --fuzz 2000
+"""
+import argparse
+import glob
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+MOCK_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, MOCK_DIR)
+
+import handle_adt_a04  # noqa: E402
+import handle_orm_o01  # noqa: E402
+import lab_results  # noqa: E402
+from datastore import DataStore  # noqa: E402
+from identifiers import IdentifierAllocator  # noqa: E402
+from er7 import ER7Message  # noqa: E402
+
+PIECES = ['A', 'b', '7', '0', ' ', '^', '&', '~', '|', '\\', '\\F\\', '\\X', '.', '-', '+0200', '2024', '0425',
+          '121736', '450', '01']
+
+
+class FixedClock(datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return datetime(2024, 4, 25, 12, 17, 36)
+
+
+class FixedUUID:
+    hex = '0123456789abcdef0123456789abcdef'
+
+    @staticmethod
+    def uuid4():
+        return FixedUUID
+
+
+def load_corpus():
+    for path in sorted(glob.glob(os.path.join(MOCK_DIR, 'messages', '*.hl7'))):
+        with open(path) as f:
+            yield os.path.basename(path), f.read().replace('\r\n', '\r').replace('\n', '\r').strip()
+
+
+def render_both(template_fn, hl7apy_fn, data):
+    results = []
+    for fn in (template_fn, hl7apy_fn):
+        lab_results._random.seed(0)  # Same generated OBX values for both
+        try:
+            results.append(fn(data))
+        except Exception as e:
+            results.append(f"{type(e).__name__}: {e}")
+    return results
+
+
+def check(name, template_fn, hl7apy_fn, data):
+    template, reference = render_both(template_fn, hl7apy_fn, data)
+    if template != reference:
+        print(f"MISMATCH {name}\n  hl7apy:   {reference!r}\n  template: {template!r}")
+        return False
+    return True
+
+
+def corpus_cases(datastore, allocator):
+    for name, message in load_corpus():
+        try:
+            data = ER7Message(message)
+        except ValueError:
+            continue  # Rejected by the server as well
+        if 'pid' not in data or 'ssn_number_patient' not in data['pid']:
+            continue
+        data['pid'] = handle_adt_a04.store_patient(data['pid'], datastore, allocator)
+        if 'orc' in data and 'obr' in data:
+            yield name, handle_orm_o01.create_oru_r01_response_message, handle_orm_o01.create_oru_r01_hl7apy_message, data
+        else:
+            yield name, handle_adt_a04.create_adt_a04_response_message, handle_adt_a04.create_adt_a04_hl7apy_message, data
+            data = dict(data, pv2={'accommodation_code': 'TASK-1'})
+            yield name + ' +PV2', handle_adt_a04.create_adt_a04_response_message, handle_adt_a04.create_adt_a04_hl7apy_message, data
+
+
+def fuzz_value(rng):
+    if rng.random() < 0.1:
+        return ''
+    return ''.join(rng.choice(PIECES) for _ in range(rng.randint(1, 8)))
+
+
+def fuzz_cases(rng, count):
+    for n in range(count):
+        pid = {key: fuzz_value(rng) for key in handle_orm_o01.ORU_R01_PID_FIELDS}
+        pid['identifiers'] = {key: fuzz_value(rng) for key in ('mr', 'pi', 'hub')}
+        pid['patient_identifier_list'] = '~'.join(fuzz_value(rng) for _ in range(rng.randint(1, 4)))
+        orc = {key: fuzz_value(rng) for key in ('placer_order_number', 'filler_order_number')}
+        obr = {key: fuzz_value(rng) for key in ('universal_service_identifier', 'observation_date_time',
+                                                'specimen_source', 'ordering_provider')}
+        if lab_results.lab_tests and rng.random() < 0.5:
+            obr['universal_service_identifier'] = rng.choice(list(lab_results.lab_tests)) + '^' + fuzz_value(rng)
+        yield f"fuzz ORU {n}", handle_orm_o01.create_oru_r01_response_message, \
+            handle_orm_o01.create_oru_r01_hl7apy_message, {'pid': pid, 'orc': orc, 'obr': obr}
+        yield f"fuzz ADT {n}", handle_adt_a04.create_adt_a04_response_message, \
+            handle_adt_a04.create_adt_a04_hl7apy_message, {'pid': pid, 'pv2': {'accommodation_code': fuzz_value(rng)}}
+
+
+def timed(cases, index):
+    start = time.perf_counter()
+    for case in cases:
+        try:
+            case[index](case[3])
+        except Exception:
+            pass
+    return (time.perf_counter() - start) / len(cases)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fuzz', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    for module in (handle_adt_a04, handle_orm_o01):
+        module.datetime = FixedClock
+    handle_orm_o01.uuid = FixedUUID
+
+    with tempfile.TemporaryDirectory() as tmp:
+        datastore = DataStore(os.path.join(tmp, 'data.json'))
+        # Private allocator state as well, so the check leaves no identifiers.json behind
+        allocator = IdentifierAllocator(os.path.join(tmp, 'identifiers.json'))
+        corpus = list(corpus_cases(datastore, allocator))
+        datastore.close()
+    fuzz = list(fuzz_cases(random.Random(args.seed), args.fuzz))
+
+    failures = sum(not check(*case) for case in corpus + fuzz)
+    print(f"{len(corpus)} corpus and {len(fuzz)} fuzz responses, {failures} mismatches")
+
+    for label, cases in (('corpus', corpus), ('fuzz', fuzz[:200])):
+        template, reference = timed(cases, 1), timed(cases, 2)
+        print(f"{label:>6}: hl7apy {reference * 1e6:8.0f} us/msg  template {template * 1e6:6.0f} us/msg  "
+              f"({reference / template:.0f}x)")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
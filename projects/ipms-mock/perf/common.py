@@ -0,0 +1,21 @@
+"""Helpers shared by the perf scripts."""
+import socket
+import time
+
+
+def percentile(values, pct):
+    """The ``pct`` percentile of sorted ``values``, NaN when there are none."""
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def wait_for_port(port, timeout=15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"server did not start listening on port {port}")
@@ -0,0 +1,121 @@
+"""Throughput comparison of the threaded (hl7apy) and asyncio MLLP server engines.
+
+Starts ``server.py`` once per engine in a scratch directory, fires ADT^A04 messages
+with unique Omang numbers / control IDs at it from a configurable number of concurrent
+connections and prints throughput and ACK latency for each run.
+
+    python perf/compare_engines.py --messages 1000 --concurrency 200
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+PERF_DIR = os.path.dirname(os.path.abspath(__file__))
+MOCK_DIR = os.path.dirname(PERF_DIR)
+sys.path.insert(0, PERF_DIR)
+
+from common import percentile, wait_for_port  # noqa: E402
+
+TEMPLATE_FILE = os.path.join(MOCK_DIR, 'messages', '1_ADT_A.hl7')
+
+
+def load_template(path):
+    with open(path) as f:
+        return f.read().replace('\r\n', '\r').replace('\n', '\r').strip('\r')
+
+
+def build_message(template, index):
+    segments = []
+    for segment in template.split('\r'):
+        fields = segment.split('|')
+        if fields[0] == 'MSH':
+            fields[9] = uuid.uuid4().hex
+        elif fields[0] == 'PID':
+            fields[19] = f"9{index:08d}"
+        segments.append('|'.join(fields))
+    return b'\x0b' + '\r'.join(segments).encode() + b'\x1c\r'
+
+
+async def send_one(port, frame, keepalive, conn):
+    if conn is None or not keepalive:
+        conn = await asyncio.open_connection('127.0.0.1', port)
+    reader, writer = conn
+    writer.write(frame)
+    await writer.drain()
+    ack = await reader.readuntil(b'\x1c\r')
+    if not keepalive:
+        writer.close()
+        conn = None
+    return ack, conn
+
+
+async def run_load(port, frames, concurrency, keepalive):
+    latencies = []
+    errors = 0
+    queue = iter(frames)
+
+    async def worker():
+        nonlocal errors
+        conn = None
+        for frame in queue:
+            started = time.perf_counter()
+            try:
+                ack, conn = await send_one(port, frame, keepalive, conn)
+                if b'MSA|AA|' not in ack:
+                    errors += 1
+            except (OSError, asyncio.IncompleteReadError):
+                errors += 1
+                conn = None
+                continue
+            latencies.append(time.perf_counter() - started)
+        if conn is not None:
+            conn[1].close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return time.perf_counter() - started, sorted(latencies), errors
+
+
+def bench_engine(engine, port, frames, concurrency, keepalive):
+    workdir = tempfile.mkdtemp(prefix=f'ipms-{engine}-')
+    # Point the delayed ADT^A04 responses at a closed local port so they fail fast instead of resolving
+    # host.docker.internal while the benchmark is running
+    env = dict(os.environ, SERVER_ENGINE=engine, SERVER_DOMAIN='127.0.0.1', SERVER_PORT=str(port),
+               MLLP_CLIENT_HOST='127.0.0.1', MLLP_CLIENT_PORT='9')
+    proc = subprocess.Popen([sys.executable, os.path.join(MOCK_DIR, 'server.py')], cwd=workdir, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        elapsed, latencies, errors = asyncio.run(run_load(port, frames, concurrency, keepalive))
+    finally:
+        proc.terminate()
+        proc.wait()
+    print(f"{engine:>9} | {len(latencies) / elapsed:9.1f} msg/s | "
+          f"p50 {percentile(latencies, 50) * 1000:7.2f} ms | p99 {percentile(latencies, 99) * 1000:7.2f} ms | "
+          f"errors {errors}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--port', type=int, default=2585)
+    parser.add_argument('--engines', default='threaded,asyncio')
+    parser.add_argument('--keepalive', action='store_true',
+                        help='reuse connections (only meaningful for the asyncio engine)')
+    args = parser.parse_args()
+
+    template = load_template(TEMPLATE_FILE)
+    frames = [build_message(template, i) for i in range(args.messages)]
+    print(f"{args.messages} ADT^A04 messages, {args.concurrency} concurrent connections")
+    for engine in args.engines.split(','):
+        bench_engine(engine, args.port, frames, args.concurrency, args.keepalive)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+"""Load generator: replays the messages/ corpus against a running mock and checks an SLO.
+
+Corpus files are grouped into patient scenarios by their number prefix (``1_ADT_A``,
+``1_ADT_B``, ``1_ORM``, ... form scenario 1; un-numbered files are scenarios of their own).
+Each of ``--patients`` virtual patients replays one scenario, in file order, with its own
+Omang in PID-19 and in the SS identifier of PID-3 and a fresh MSH-10 on every message.
+Only ADT^A04 and ORM^O01 messages are replayed, as the mock closes the connection on other
+types. ``--concurrency`` patients are in flight at once. With ``--rate`` the sends follow a
+fixed schedule and latency is measured from the scheduled send time, so a stalled server is
+not hidden by the generator slowing down with it.
+
+Every message must be answered with AA; any other answer, an MSA-2 that does not echo
+MSH-10, a timeout or a connection error is an error.
+Exits with 1 when one of the ``--max-*`` / ``--min-*`` limits is missed. ``--ack-log``
+writes the time, type and Omang of every AA to a CSV file for ``perf/mllp_sink.py``.
+
+    python perf/loadgen.py --port 2575 --patients 500 --concurrency 50 --rate 200 --max-p99 50
+"""
+import argparse
+import asyncio
+import csv
+import glob
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter, defaultdict
+
+PERF_DIR = os.path.dirname(os.path.abspath(__file__))
+MOCK_DIR = os.path.dirname(PERF_DIR)
+sys.path[:0] = [MOCK_DIR, PERF_DIR]
+
+from common import percentile, wait_for_port  # noqa: E402
+from mllp import END_BLOCK, acknowledged_control_id, encode_frame  # noqa: E402
+
+HANDLED_TYPES = ('ADT^A04', 'ORM^O01')  # The types server.py registers handlers for
+PERCENTILES = (50, 90, 95, 99)
+
+
+def load_scenarios(pattern):
+    scenarios = defaultdict(list)
+    for path in sorted(glob.glob(os.path.join(MOCK_DIR, 'messages', pattern))):
+        with open(path) as f:
+            message = f.read().replace('\r\n', '\r').replace('\n', '\r').strip()
+        if not message.startswith('MSH') or _message_type(message.split('\r', 1)[0].split('|')) not in HANDLED_TYPES:
+            continue  # Empty, not ER7 or not handled by server.py
+        name = os.path.basename(path)
+        prefix = re.match(r'(\d+)_', name)
+        scenarios[prefix.group(1) if prefix else name].append(message)
+    return list(scenarios.values())
+
+
+def personalise(message, omang):
+    """The message with a new MSH-10 and ``omang`` as the patient's Omang; returns (frame, type, MSH-10)."""
+    control_id = uuid.uuid4().hex
+    segments = []
+    for segment in message.split('\r'):
+        fields = segment.split('|')
+        if fields[0] == 'MSH':
+            fields += [''] * (10 - len(fields))
+            fields[9] = control_id
+            message_type = _message_type(fields)
+        elif fields[0] == 'PID':
+            fields += [''] * (20 - len(fields))
+            fields[19] = omang
+            fields[3] = '~'.join(_with_omang(identifier, omang) for identifier in fields[3].split('~'))
+        segments.append('|'.join(fields))
+    return encode_frame('\r'.join(segments)), message_type, control_id
+
+
+def _message_type(msh_fields):
+    return '^'.join(msh_fields[8].split('^')[:2]) if len(msh_fields) > 8 else ''
+
+
+def _with_omang(identifier, omang):
+    components = identifier.split('^')
+    if len(components) > 4 and components[4] == 'SS':
+        components[0] = omang
+    return '^'.join(components)
+
+
+class LoadRun:
+    def __init__(self, args, scenarios):
+        self.args = args
+        self.scenarios = scenarios
+        self.latencies = defaultdict(list)  # message type -> seconds
+        self.codes = Counter()
+        self.errors = Counter()
+        self.acked = []  # (wall clock time, message type, Omang) of every AA
+        self.sent = 0
+        self._slot = 0
+        self._started = None
+
+    async def run(self):
+        patients = iter(range(self.args.patients))
+        self._started = time.perf_counter()
+        await asyncio.gather(*(self._worker(patients) for _ in range(self.args.concurrency)))
+        return time.perf_counter() - self._started
+
+    async def _worker(self, patients):
+        for patient in patients:
+            omang = str(self.args.first_omang + patient)
+            conn = None
+            for message in self.scenarios[patient % len(self.scenarios)]:
+                conn = await self._send(message, omang, conn)
+            if conn is not None:
+                conn[1].close()
+
+    async def _scheduled_start(self):
+        if not self.args.rate:
+            return time.perf_counter()
+        # Claim the next slot of the global schedule and wait for it
+        scheduled = self._started + self._slot / self.args.rate
+        self._slot += 1
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return scheduled
+
+    async def _send(self, message, omang, conn):
+        frame, message_type, control_id = personalise(message, omang)
+        started = await self._scheduled_start()
+        self.sent += 1
+        try:
+            if conn is None:
+                conn = await asyncio.open_connection(self.args.host, self.args.port)
+            reader, writer = conn
+            writer.write(frame)
+            await writer.drain()
+            ack = await asyncio.wait_for(reader.readuntil(END_BLOCK), self.args.timeout)
+        except asyncio.TimeoutError:
+            self.errors['timeout'] += 1
+            return _close(conn)
+        except (OSError, asyncio.IncompleteReadError) as e:
+            self.errors[type(e).__name__] += 1
+            return _close(conn)
+        self.latencies[message_type].append(time.perf_counter() - started)
+
+        code = re.search(rb'\rMSA\|(\w*)', ack)
+        code = code.group(1).decode() if code else 'no MSA'
+        self.codes[code] += 1
+        if code != 'AA':
+            self.errors[f"{message_type} answered {code}"] += 1
+        elif acknowledged_control_id(ack) != control_id:
+            self.errors['MSA-2 mismatch'] += 1
+        else:
+            self.acked.append((time.time(), message_type, omang))
+        return conn if self.args.keepalive else _close(conn)
+
+
+def _close(conn):
+    if conn is not None:
+        conn[1].close()
+    return None
+
+
+def report(run, elapsed):
+    latencies = sorted(value for values in run.latencies.values() for value in values)
+    errors = sum(run.errors.values())
+    summary = {
+        'throughput': len(latencies) / elapsed,
+        'error_rate': errors / run.sent if run.sent else 0.0,
+    }
+    summary.update({f"p{pct}": percentile(latencies, pct) * 1000 for pct in PERCENTILES})
+
+    print(f"{run.sent} messages in {elapsed:.2f} s, {len(latencies)} ACKs, {summary['throughput']:.1f} msg/s")
+    print("ACK codes: " + ', '.join(f"{code} {count}" for code, count in sorted(run.codes.items())))
+    print("latency:   " + '  '.join(f"p{pct} {summary[f'p{pct}']:.2f} ms" for pct in PERCENTILES)
+          + f"  max {(latencies[-1] if latencies else float('nan')) * 1000:.2f} ms")
+    for message_type, values in sorted(run.latencies.items()):
+        values.sort()
+        print(f"  {message_type:>9}: {len(values):6d} msgs  p50 {percentile(values, 50) * 1000:7.2f} ms  "
+              f"p99 {percentile(values, 99) * 1000:7.2f} ms")
+    print(f"errors:    {errors} ({summary['error_rate']:.2%})")
+    for error, count in run.errors.most_common():
+        print(f"  {error}: {count}")
+    return summary
+
+
+def missed_slos(args, summary):
+    missed = []
+    for pct in PERCENTILES:
+        limit = getattr(args, f"max_p{pct}")
+        if limit is not None and not summary[f"p{pct}"] <= limit:
+            missed.append(f"p{pct} {summary[f'p{pct}']:.2f} ms > {limit} ms")
+    if summary['error_rate'] > args.max_error_rate:
+        missed.append(f"error rate {summary['error_rate']:.2%} > {args.max_error_rate:.2%}")
+    if args.min_throughput is not None and summary['throughput'] < args.min_throughput:
+        missed.append(f"throughput {summary['throughput']:.1f} msg/s < {args.min_throughput} msg/s")
+    return missed
+
+
+def spawn_server(engine, port):
+    # Delayed responses go to a closed local port unless MLLP_CLIENT_* point at a sink
+    env = dict(os.environ, SERVER_ENGINE=engine, SERVER_DOMAIN='127.0.0.1', SERVER_PORT=str(port))
+    env.setdefault('MLLP_CLIENT_HOST', '127.0.0.1')
+    env.setdefault('MLLP_CLIENT_PORT', '9')
+    env.setdefault('MLLP_CLIENT_ORU_PORT', '9')
+    proc = subprocess.Popen([sys.executable, os.path.join(MOCK_DIR, 'server.py')],
+                            cwd=tempfile.mkdtemp(prefix=f'ipms-loadgen-{engine}-'), env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port(port)
+    return proc
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=2575)
+    parser.add_argument('--spawn', metavar='ENGINE',
+                        help='start server.py with this SERVER_ENGINE in a scratch directory first')
+    parser.add_argument('--files', default='*.hl7', help='glob of the messages/ files to replay')
+    parser.add_argument('--patients', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--rate', type=float, default=0, help='messages per second, 0 sends as fast as ACKs come')
+    parser.add_argument('--keepalive', action='store_true', help="reuse a patient's connection for its messages")
+    parser.add_argument('--timeout', type=float, default=10, help='seconds to wait for an ACK')
+    parser.add_argument('--first-omang', type=int, default=900000000)
+    parser.add_argument('--ack-log', help='write the time, type and Omang of every AA to this CSV file')
+    for pct in PERCENTILES:
+        parser.add_argument(f'--max-p{pct}', type=float, metavar='MS')
+    parser.add_argument('--max-error-rate', type=float, default=0.0)
+    parser.add_argument('--min-throughput', type=float, metavar='MSG/S')
+    args = parser.parse_args()
+
+    scenarios = load_scenarios(args.files)
+    if not scenarios:
+        parser.error(f"no messages match {args.files}")
+    print(f"{args.patients} patients over {len(scenarios)} scenarios, {args.concurrency} concurrent"
+          + (f", {args.rate:g} msg/s" if args.rate else ''))
+
+    server = spawn_server(args.spawn, args.port) if args.spawn else None
+    try:
+        run = LoadRun(args, scenarios)
+        elapsed = asyncio.run(run.run())
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    if args.ack_log:
+        with open(args.ack_log, 'w', newline='') as f:
+            csv.writer(f).writerows(run.acked)
+
+    missed = missed_slos(args, report(run, elapsed))
+    for miss in missed:
+        print(f"SLO missed: {miss}")
+    sys.exit(1 if missed else 0)
+
+
+if __name__ == '__main__':
+    main()
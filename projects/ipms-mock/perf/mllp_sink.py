@@ -0,0 +1,164 @@
+"""Stand-in for the MLLP listeners the mock sends its ADT^A04/ORU^R01 responses to.
+
+Listens on ``--ports`` (3001 and 3002, the MLLP_CLIENT_PORT/MLLP_CLIENT_ORU_PORT
+defaults), ACKs every frame with MSA-2 echoing its MSH-10 and records when each frame
+arrived. Every ``--interval`` seconds it prints the messages delivered per second, and on
+exit (Ctrl-C, ``--duration`` or ``--expect`` messages received) a summary per message type.
+
+Given the ``--ack-log`` written by ``perf/loadgen.py``, it also reports how late each
+response arrived: a response is due ``--delay`` seconds (RESPONSE_DELAY) after the inbound
+ADT^A04 (ADT^A04 response) or ORM^O01 (ORU^R01 response) of the same Omang was ACKed.
+``--record`` writes every arrival to a CSV file.
+
+    python perf/mllp_sink.py --delay 10 --ack-log acks.csv
+    SERVER_ENGINE=asyncio MLLP_CLIENT_HOST=127.0.0.1 python server.py
+    python perf/loadgen.py --patients 500 --rate 100 --ack-log acks.csv
+"""
+import argparse
+import asyncio
+import csv
+import os
+import signal
+import sys
+import time
+from collections import Counter, defaultdict, deque
+
+PERF_DIR = os.path.dirname(os.path.abspath(__file__))
+MOCK_DIR = os.path.dirname(PERF_DIR)
+sys.path[:0] = [MOCK_DIR, PERF_DIR]
+
+from common import percentile  # noqa: E402
+from helper import create_ack_response  # noqa: E402
+from mllp import MLLPFrameDecoder, message_control_id  # noqa: E402
+
+RESPONSE_TYPES = {'ADT^A04': 'ADT^A04', 'ORM^O01': 'ORU^R01'}  # Inbound type -> response it schedules
+
+
+def response_fields(message):
+    """(message type, Omang) of a response: MSH-9 and the SS identifier of PID-3, else PID-19."""
+    message_type = omang = ''
+    for segment in message.split('\r'):
+        fields = segment.split('|')
+        if fields[0] == 'MSH' and len(fields) > 8:
+            message_type = '^'.join(fields[8].split('^')[:2])
+        elif fields[0] == 'PID':
+            for identifier in fields[3].split('~') if len(fields) > 3 else ():
+                components = identifier.split('^')
+                if len(components) > 4 and components[4] == 'SS':
+                    omang = components[0]
+            if not omang and len(fields) > 19:
+                omang = fields[19]
+    return message_type, omang
+
+
+class Sink:
+    def __init__(self, expect=None):
+        self.arrivals = []  # (arrival time, port, MSH-10, message type, Omang)
+        self.expect = expect
+        self.done = asyncio.Event()
+
+    async def handle(self, reader, writer):
+        port = writer.get_extra_info('sockname')[1]
+        decoder = MLLPFrameDecoder()
+        try:
+            while True:
+                chunk = await reader.read(65536)
+                if not chunk:
+                    break
+                arrived = time.time()
+                for frame in decoder.feed(chunk):
+                    message = frame.decode('utf-8', 'replace')
+                    self.arrivals.append((arrived, port, message_control_id(message) or '') + response_fields(message))
+                    writer.write(create_ack_response(message))
+                await writer.drain()
+                if self.expect and len(self.arrivals) >= self.expect:
+                    self.done.set()
+        except (ConnectionError, asyncio.CancelledError):
+            pass  # Pooled connections are still open when the sink stops
+        finally:
+            writer.close()
+
+    def rate_since(self, since):
+        return sum(1 for arrival in self.arrivals if arrival[0] >= since)
+
+
+def read_ack_log(path):
+    due = defaultdict(deque)  # (response type, Omang) -> times the inbound messages were ACKed
+    with open(path, newline='') as f:
+        for acked, message_type, omang in sorted(csv.reader(f), key=lambda row: float(row[0])):
+            if message_type in RESPONSE_TYPES:
+                due[RESPONSE_TYPES[message_type], omang].append(float(acked))
+    return due
+
+
+def report(sink, started, args):
+    arrivals = sink.arrivals
+    elapsed = (arrivals[-1][0] - arrivals[0][0]) if len(arrivals) > 1 else 0.0
+    print(f"{len(arrivals)} messages in {time.time() - started:.1f} s"
+          + (f", {(len(arrivals) - 1) / elapsed:.1f} msg/s from first to last" if elapsed else ''))
+    for message_type, count in sorted(Counter(arrival[3] for arrival in arrivals).items()):
+        print(f"  {message_type or '?':>9}: {count}")
+    duplicates = len(arrivals) - len({arrival[2] for arrival in arrivals})
+    if duplicates:
+        print(f"duplicate MSH-10s: {duplicates}")
+
+    if args.ack_log:
+        due = read_ack_log(args.ack_log)
+        lateness = defaultdict(list)
+        unmatched = 0
+        for arrived, _, _, message_type, omang in arrivals:
+            acks = due.get((message_type, omang))
+            if not acks:
+                unmatched += 1
+                continue
+            lateness[message_type].append(arrived - (acks.popleft() + args.delay))
+        print(f"delay past the scheduled {args.delay:g} s (p50 / p99 / max):")
+        for message_type, values in sorted(lateness.items()):
+            values.sort()
+            print(f"  {message_type:>9}: {percentile(values, 50) * 1000:8.1f} / {percentile(values, 99) * 1000:8.1f} / "
+                  f"{values[-1] * 1000:8.1f} ms")
+        missing = sum(len(acks) for acks in due.values())
+        print(f"responses not matched to an ACK: {unmatched}, ACKed messages without a response: {missing}")
+
+    if args.record:
+        with open(args.record, 'w', newline='') as f:
+            csv.writer(f).writerows(arrivals)
+
+
+async def serve(args):
+    sink = Sink(args.expect)
+    servers = [await asyncio.start_server(sink.handle, args.host, port) for port in args.ports]
+    print(f"Listening on {', '.join(f'{args.host}:{port}' for port in args.ports)}")
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, sink.done.set)
+
+    started = time.time()
+    deadline = started + args.duration if args.duration else None
+    while not sink.done.is_set() and (deadline is None or time.time() < deadline):
+        try:
+            await asyncio.wait_for(sink.done.wait(), args.interval)
+        except asyncio.TimeoutError:
+            print(f"{len(sink.arrivals):8d} received, {sink.rate_since(time.time() - args.interval) / args.interval:8.1f} msg/s")
+    for server in servers:
+        server.close()
+    report(sink, started, args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--ports', type=lambda value: [int(port) for port in value.split(',')], default=[3001, 3002])
+    parser.add_argument('--interval', type=float, default=5, help='seconds between progress lines')
+    parser.add_argument('--duration', type=float, help='stop after this many seconds')
+    parser.add_argument('--expect', type=int, help='stop once this many messages arrived')
+    parser.add_argument('--delay', type=float, default=float(os.getenv('RESPONSE_DELAY', '10')),
+                        help="the mock's RESPONSE_DELAY")
+    parser.add_argument('--ack-log', help="CSV of inbound ACK times written by perf/loadgen.py --ack-log")
+    parser.add_argument('--record', help='write every arrival to this CSV file')
+    args = parser.parse_args()
+    asyncio.run(serve(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+import cProfile
+import functools
+import io
+import logging
+import os
+import pstats
+import signal
+import sys
+import threading
+import time
+
+from metrics import Histogram, registry
+
+PROFILE_HOOKS = os.getenv('PROFILE_HOOKS', '0') == '1'  # Time the hooked functions from startup
+PROFILE_MESSAGES = int(os.getenv('PROFILE_MESSAGES', '1000'))  # Messages covered by one cProfile capture
+PROFILE_AT_START = os.getenv('PROFILE_AT_START', '0') == '1'  # Capture the first PROFILE_MESSAGES messages
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')  # Where captures are written
+
+FUNCTION_SECONDS = registry.register(Histogram(
+    'ipms_function_duration_seconds', 'Time spent in the hooked functions while hooks are installed', ('function',)))
+
+_local = threading.local()
+
+
+class _Capture:
+    """cProfile data of every thread's outermost hooked call, until ``messages`` messages were handled."""
+    def __init__(self, messages, path):
+        self.messages = messages
+        self.path = path
+        self._profiles = []
+        self._handled = 0
+        self._lock = threading.Lock()
+
+    def call(self, function, args, kwargs):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            profile = None  # Another profiler is active on this thread (Python 3.12+: in the process)
+        _local.profiling = True
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _local.profiling = False
+            if profile is not None:
+                profile.disable()
+                with self._lock:
+                    self._profiles.append(profile)
+
+    def message_handled(self):
+        """True for the message that completes the capture."""
+        with self._lock:
+            self._handled += 1
+            return self._handled == self.messages
+
+    def write(self):
+        with self._lock:
+            profiles, self._profiles = self._profiles, []
+        if not profiles:
+            logging.warning("Nothing was profiled, %s not written", self.path)
+            return
+        stats = pstats.Stats(*profiles)
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        stats.dump_stats(self.path)
+        summary = io.StringIO()
+        stats.stream = summary
+        stats.sort_stats('cumulative').print_stats(20)
+        logging.info("Wrote the profile of %s messages to %s\n%s", self.messages, self.path, summary.getvalue())
+
+
+class Profiler:
+    """Timing and cProfile hooks on named functions, swapped in only while in use.
+
+    ``hook(module, qualname)`` registers a function (``'HL7Handler.reply'`` for a method) by
+    name. Hooks replace the attribute with a timing wrapper while timing is enabled or a
+    capture is running and put the original back afterwards, so they cost nothing when off.
+    Only calls made through the module or class attribute are seen.
+    """
+    def __init__(self):
+        self._hooks = []  # (owner, attribute, label, counts messages)
+        self._originals = {}
+        self._timing = False
+        self._capture = None
+        self._lock = threading.Lock()
+
+    def hook(self, module, qualname, counts_messages=False):
+        owner = sys.modules[module]
+        *path, attribute = qualname.split('.')
+        for name in path:
+            owner = getattr(owner, name)
+        self._hooks.append((owner, attribute, qualname, counts_messages))
+
+    def enable_timing(self):
+        with self._lock:
+            self._timing = True
+            self._install()
+
+    def start_capture(self, messages=PROFILE_MESSAGES, path=None):
+        """Profiles the next ``messages`` messages and writes them to ``path`` (under PROFILE_DIR by default)."""
+        if path is None:
+            path = os.path.join(PROFILE_DIR, time.strftime('profile-%Y%m%d-%H%M%S.pstats'))
+        with self._lock:
+            if self._capture is not None:
+                logging.warning("A profile capture is already running")
+                return
+            self._capture = _Capture(messages, path)
+            self._install()
+        logging.info("Profiling the next %s messages", messages)
+
+    def _install(self):
+        if self._originals:
+            return
+        for owner, attribute, label, counts_messages in self._hooks:
+            original = owner.__dict__[attribute]
+            self._originals[owner, attribute] = original
+            setattr(owner, attribute, self._wrap(original, label, counts_messages))
+
+    def _uninstall(self):
+        for (owner, attribute), original in self._originals.items():
+            setattr(owner, attribute, original)
+        self._originals = {}
+
+    def _wrap(self, function, label, counts_messages):
+        @functools.wraps(function)
+        def hooked(*args, **kwargs):
+            capture = self._capture
+            started = time.perf_counter()
+            try:
+                if capture is not None and not getattr(_local, 'profiling', False):
+                    return capture.call(function, args, kwargs)
+                return function(*args, **kwargs)
+            finally:
+                FUNCTION_SECONDS.observe(time.perf_counter() - started, function=label)
+                if counts_messages and capture is not None and capture.message_handled():
+                    self._finish(capture)
+        return hooked
+
+    def _finish(self, capture):
+        with self._lock:
+            if self._capture is capture:
+                self._capture = None
+                if not self._timing:
+                    self._uninstall()
+        threading.Thread(target=capture.write, name='profile-writer', daemon=True).start()
+
+    def install_signal_handler(self, signum=getattr(signal, 'SIGUSR1', None)):
+        if signum is not None:
+            # The handler may interrupt a thread holding the lock, so start from another one
+            signal.signal(signum, lambda *_: threading.Thread(target=self.start_capture, daemon=True).start())
+
+
+profiler = Profiler()
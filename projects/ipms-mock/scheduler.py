@@ -0,0 +1,165 @@
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+RESPONSE_DELAY = float(os.getenv('RESPONSE_DELAY', '10'))  # Seconds before the ADT^A04/ORU^R01 response is sent
+SENDER_WORKERS = int(os.getenv('SENDER_WORKERS', '4'))  # Threads sending due responses
+MAX_PENDING_RESPONSES = int(os.getenv('MAX_PENDING_RESPONSES', '10000'))  # Responses held in memory at most
+RESPONSE_TIME_SCALE = float(os.getenv('RESPONSE_TIME_SCALE', '1'))  # Multiplies every response delay, e.g. 0.001 for test suites
+RESPONSE_CLOCK = os.getenv('RESPONSE_CLOCK', 'real').lower()  # 'real', or 'manual': delays only pass when advanced
+
+
+class SchedulerFull(Exception):
+    """Raised when scheduling a response would exceed MAX_PENDING_RESPONSES."""
+
+
+class ResponseScheduler:
+    """Runs delayed callbacks from one timer thread and a small pool of sender threads.
+
+    Scheduled calls are kept in a heap ordered by due time; the timer thread sleeps until
+    the earliest one is due and hands it to the sender pool. A response counts as pending
+    from the moment it is scheduled until its callback returns, and no more than
+    ``max_pending`` can be pending at once. With ``discard`` set, calls are dropped instead
+    of scheduled (batch ingest loads patients without sending responses).
+
+    Delays are multiplied by ``time_scale``. With ``clock='manual'`` the scheduler keeps
+    virtual time that stands still until ``advance`` moves it, and the calls it passes are
+    handed to the senders in due order.
+    """
+    def __init__(self, workers=SENDER_WORKERS, max_pending=MAX_PENDING_RESPONSES,
+                 time_scale=RESPONSE_TIME_SCALE, clock=RESPONSE_CLOCK):
+        if clock not in ('real', 'manual'):
+            raise ValueError(f"Unknown RESPONSE_CLOCK '{clock}', expected 'real' or 'manual'")
+        self.max_pending = max_pending
+        self.time_scale = time_scale
+        self._virtual_time = 0.0 if clock == 'manual' else None
+        self.discard = False
+        self._workers = workers
+        self._heap = []
+        self._sequence = itertools.count()  # Keeps FIFO order for calls due at the same time
+        self._condition = threading.Condition()
+        self._pending = 0
+        self._executor = None
+        self._timer = None
+        self._stopped = False
+        self._local = threading.local()  # Slots the calling thread reserved and has not used yet
+
+    def schedule(self, delay, callback, *args):
+        with self._condition:
+            if self._stopped:
+                raise RuntimeError("The response scheduler is stopped")
+            if self.discard:
+                return
+            reserved = getattr(self._local, 'reserved', 0)
+            if reserved:
+                self._local.reserved = reserved - 1  # Already counted as pending
+            elif self._pending >= self.max_pending:
+                raise SchedulerFull(f"{self._pending} responses already pending (limit {self.max_pending})")
+            self._start()
+            sequence = next(self._sequence)
+            heapq.heappush(self._heap, (self._now() + delay * self.time_scale, sequence, callback, args))
+            if not reserved:
+                self._pending += 1
+            # Only wake the timer when the new call is due before whatever it is sleeping for
+            if self._heap[0][1] == sequence:
+                self._condition.notify()
+
+    @contextmanager
+    def reserve(self, count):
+        """Holds ``count`` pending slots for the calls the current thread is about to schedule.
+
+        Raises SchedulerFull up front when they do not fit, so a handler cannot fail to
+        schedule its response after storing the patient. Unused slots are freed on exit.
+        """
+        with self._condition:
+            if self._pending + count > self.max_pending:
+                raise SchedulerFull(f"{self._pending} responses already pending (limit {self.max_pending})")
+            self._pending += count
+        self._local.reserved = count
+        try:
+            yield
+        finally:
+            unused, self._local.reserved = self._local.reserved, 0
+            with self._condition:
+                self._pending -= unused
+
+    def pending(self):
+        with self._condition:
+            return self._pending
+
+    def advance(self, seconds=None):
+        """Moves the manual clock ``seconds`` (as configured, before ``time_scale``) forward.
+
+        Without ``seconds`` it moves to the last due call. Returns the number of calls it passed.
+        """
+        with self._condition:
+            if self._virtual_time is None:
+                raise RuntimeError("Only a manual response clock can be advanced")
+            if seconds is None:
+                target = max((due for due, *_ in self._heap), default=self._virtual_time)
+            else:
+                target = self._virtual_time + seconds * self.time_scale
+            passed = sum(1 for due, *_ in self._heap if due <= target)
+            self._virtual_time = max(target, self._virtual_time)
+            self._condition.notify()
+            return passed
+
+    def stop(self):
+        """Stops the timer and waits for the responses being sent.
+
+        Returns the responses that were not due yet as ``(due time, callback, args)``, the due
+        time on the wall clock so another process can schedule them. The time left is given
+        back in configured seconds, before ``time_scale``.
+        """
+        with self._condition:
+            self._stopped = True
+            heap, self._heap = self._heap, []
+            self._pending -= len(heap)
+            self._condition.notify()
+            now = self._now()
+        if self._timer is not None:
+            self._timer.join()
+            self._executor.shutdown(wait=True)
+        wall_now = time.time()
+        scale = self.time_scale or 1
+        return [(wall_now + (due - now) / scale, callback, args) for due, _, callback, args in sorted(heap)]
+
+    def _now(self):
+        return time.monotonic() if self._virtual_time is None else self._virtual_time
+
+    def _start(self):
+        if self._timer is None:
+            self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='response-sender')
+            self._timer = threading.Thread(target=self._run, name='response-scheduler', daemon=True)
+            self._timer.start()
+
+    def _run(self):
+        with self._condition:
+            while not self._stopped:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                timeout = self._heap[0][0] - self._now()
+                if timeout > 0:
+                    # The manual clock only moves in advance(), which notifies
+                    self._condition.wait(timeout if self._virtual_time is None else None)
+                    continue
+                _, _, callback, args = heapq.heappop(self._heap)
+                self._executor.submit(self._send, callback, args)
+
+    def _send(self, callback, args):
+        try:
+            callback(*args)
+        except Exception:
+            logging.exception("Error sending scheduled response (%s)", callback.__name__)
+        finally:
+            with self._condition:
+                self._pending -= 1
+
+
+response_scheduler = ResponseScheduler()
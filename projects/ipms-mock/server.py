@@ -1,27 +1,74 @@
+import argparse
 import os
+import signal
+import sys
+import threading
+import time
 import logging
-from hl7apy.parser import parse_message
+from hl7apy.parser import get_message_type, parse_message
 from hl7apy.v2_5 import DTM
-from hl7apy.mllp import MLLPServer, AbstractHandler, UnsupportedMessageType
+from hl7apy.mllp import MLLPServer, MLLPRequestHandler, AbstractHandler, UnsupportedMessageType
+from socketserver import ThreadingTCPServer
 from hl7apy import parser
 
+from aio_server import AsyncMLLPServer
 from handle_adt_a04 import handle_adt_a04
 from handle_orm_o01 import handle_orm_o01
-from helper import create_error_response
+from helper import create_ack_response, create_error_response, UNSUPPORTED_MESSAGE_TYPE
+from metrics import MESSAGES, STAGE_SECONDS, METRICS_PORT, action, gauge, start_http_server
+from profiling import profiler, PROFILE_HOOKS, PROFILE_AT_START
+from log_config import MESSAGE_LOG, Redacted, configure_logging
+from lifecycle import (LISTEN_FD, SERVER_DRAIN_TIMEOUT, adopt_pending_responses, listening_socket, notify_ready,
+                       run_workers, save_pending_responses, wait_for_takeover)
+from scheduler import RESPONSE_CLOCK, response_scheduler
+from faults import fault_profiles
+from ack_cache import ack_cache
+from admission import MAX_IN_FLIGHT, Overloaded, REJECTED, admission
 
-from datastore import DataStore
+from er7 import ER7Message
+from datastore import DATASTORE_MODE, DataStore, create_backend
 datastore = DataStore()
 
-# Set up basic configuration for logging
-logging.basicConfig(level=logging.DEBUG,
-                    format='%(asctime)s - %(levelname)s - %(message)s')
+gauge('ipms_pending_responses', 'ADT^A04/ORU^R01 responses scheduled and not sent yet', response_scheduler.pending)
+gauge('ipms_datastore_patients', 'Patients in the DataStore', datastore.size)
+gauge('ipms_ack_cache_entries', 'ACKs remembered for retransmitted control IDs', lambda: len(ack_cache))
+gauge('ipms_in_flight_messages', 'Inbound messages being handled', admission.in_flight)
+
+# Log through a queue to a writer thread (LOG_LEVEL, LOG_SAMPLING, LOG_REDACT)
+configure_logging()
 
 # Environment variables for server configuration
 SERVER_DOMAIN = os.getenv('SERVER_DOMAIN', 'localhost')
 SERVER_PORT = int(os.getenv('SERVER_PORT', '2575'))
+HL7_PARSE_MODE = os.getenv('HL7_PARSE_MODE', 'lazy').lower()  # 'lazy' (ER7 view) or 'strict' (full hl7apy parse)
+SERVER_ENGINE = os.getenv('SERVER_ENGINE', 'threaded').lower()  # 'threaded' (hl7apy MLLPServer) or 'asyncio'
+SERVER_WORKERS = int(os.getenv('SERVER_WORKERS', '1'))  # Server processes sharing the port (--workers)
 
 _ROOT_PATH = os.path.dirname(os.path.abspath(__file__))
 
+def parse_full_message(hl7_message_string):
+    # Full hl7apy parse, building a dict of every segment's fields keyed by their long names
+    hl7_object = parser.parse_message(hl7_message_string, None, False)
+
+    extracted_data = {}
+    for segment in hl7_object.children:
+        segment_data = {}
+        for field in segment.children:
+            field_key = field.name.lower()  # Get the property name (e.g., msh_1)
+            field_value = field.value  # Get the field value
+            if hasattr(field, 'long_name') and field.long_name is not None:
+                long_name = field.long_name.replace(" ", "_").replace("/", "").lower()  
+
+                # if key exists, value is part of an list - append
+                if long_name in segment_data:
+                    segment_data[long_name] += f"~{field_value}" # concat the extra list item with tilde seperated
+                else:
+                    segment_data[long_name] = field_value # Use the long name as the key
+            else:
+                segment_data[field_key] = field_value # Use the property name as the key
+        extracted_data[segment.name.lower()] = segment_data
+    return extracted_data
+
 def process_hl7_message(hl7_message_string):
     try:
         # 1. Sanitize the message
@@ -32,74 +79,204 @@ def process_hl7_message(hl7_message_string):
             logging.warning("Invalid HL7 message: Does not start with MSH segment.")
             return None
 
-        # 3. Parse the HL7 message
-        hl7_object = parser.parse_message(hl7_message_string, None, False)
-
-        # 4. Extract segments with their key-value components using field names
-        extracted_data = {}
-        extracted_segment_string = """"""
-        for segment in hl7_object.children:
-            segment_data = {}
-            extracted_segment_string += "\n" + segment.value
-            for field in segment.children:
-                field_key = field.name.lower()  # Get the property name (e.g., msh_1)
-                field_value = field.value  # Get the field value
-                if hasattr(field, 'long_name') and field.long_name is not None:
-                    long_name = field.long_name.replace(" ", "_").replace("/", "").lower()  
-
-                    # if key exists, value is part of an list - append
-                    if long_name in segment_data:
-                        segment_data[long_name] += f"~{field_value}" # concat the extra list item with tilde seperated
-                    else:
-                        segment_data[long_name] = field_value # Use the long name as the key
-                else:
-                    segment_data[field_key] = field_value # Use the property name as the key
-            extracted_data[segment.name.lower()] = segment_data
-
-        # (Optional) Log the extracted data as JSON
-        logging.info(f"Incoming HL7 message: {extracted_segment_string}")
+        # (Optional) Log the incoming message, one segment per line
+        MESSAGE_LOG.info("Incoming HL7 message: \n%s", Redacted(hl7_message_string))
 
-        return extracted_data
+        # 3. Parse the HL7 message: a lazy ER7 view by default, the full hl7apy tree in strict mode
+        if HL7_PARSE_MODE == 'strict':
+            return parse_full_message(hl7_message_string)
+        return ER7Message(hl7_message_string)
     
     except Exception as e:
-        logging.error(f"Error parsing HL7 message: {e}")
+        logging.error("Error parsing HL7 message: %s", Redacted(e))
         return None
 
 class HL7Handler(AbstractHandler):
     def __init__(self, message):
-        parsed_message = process_hl7_message(message)
+        self.raw_message = message
+        with STAGE_SECONDS.time(stage='parse'):
+            parsed_message = process_hl7_message(message)
         super(HL7Handler, self).__init__(parsed_message)
 
     def reply(self):
-        logging.info(f"Parsed HL7 message: {self.incoming_message}")
+        # A retransmitted MSH-10 gets its first ACK back instead of being handled again
+        return ack_cache.reply(self.raw_message, self._handle)
+
+    def _handle(self):
+        MESSAGE_LOG.debug("Parsed HL7 message: %s", Redacted(self.incoming_message))
 
+        started = time.perf_counter()
+        message_type = 'invalid' if self.incoming_message is None else 'unsupported'
         try:
             # Properly extract message_type
             full_message_type = self.incoming_message['msh']['message_type']
 
             logging.info('Handling message type: %s', full_message_type)
 
-            if full_message_type == 'ORM^O01':
-                response = handle_orm_o01(self.incoming_message, datastore)
+            # The active fault profile may refuse the message outright
+            simulated = fault_profiles.ack_fault(full_message_type) if full_message_type in ('ORM^O01', 'ADT^A04') else None
+            if simulated is not None:
+                message_type = full_message_type
+                logging.warning("Answering %s with a simulated %s", full_message_type, simulated)
+                response = create_error_response(f"Simulated {simulated} (fault profile)", self.incoming_message, simulated)
+            elif full_message_type == 'ORM^O01':
+                message_type = full_message_type
+                with admission.admit():
+                    response = handle_orm_o01(self.incoming_message, datastore)
             elif full_message_type == 'ADT^A04':
-                response = handle_adt_a04(self.incoming_message, datastore)
+                message_type = full_message_type
+                with admission.admit():
+                    response = handle_adt_a04(self.incoming_message, datastore)
             else:
                 raise UnsupportedMessageType(
                     f"Unsupported message type: {full_message_type}")
+            ack_code = 'AA' if simulated is None else simulated
+        except UnsupportedMessageType as e:
+            logging.error("Error handling message: %s", e)
+            response = create_error_response(str(e), self.incoming_message, 'AR', UNSUPPORTED_MESSAGE_TYPE)
+            ack_code = 'AR'
+        except Overloaded as e:
+            # A quick AR telling the sender when to retry, without logging every rejection
+            REJECTED.inc(message_type=message_type, reason=e.reason)
+            response = create_ack_response(self.incoming_message, 'AR', str(e))
+            ack_code = 'AR'
         except Exception as e:
-            logging.error("Error handling message: %s", str(e))
-            response = create_error_response(str(e))
-        return response
+            logging.error("Error handling message: %s", Redacted(e))
+            # Fall back to the raw message so the ACK still echoes MSH-10 when parsing failed
+            response = create_error_response(str(e), self.raw_message if self.incoming_message is None else self.incoming_message)
+            ack_code = 'AE'
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage='handle')
+        MESSAGES.inc(message_type=message_type, ack_code=ack_code)
+        # Only processed messages are remembered: a retry after an AE/AR is handled again
+        return response, ack_code == 'AA'
+
+class RejectedMessageHandler(AbstractHandler):
+    """'ERR' handler of both engines: counts messages without a handler, then drops the connection as before."""
+    def __init__(self, exception, message):
+        self.exception = exception
+        super(RejectedMessageHandler, self).__init__(message)
+
+    def reply(self):
+        message_type = 'unsupported' if isinstance(self.exception, UnsupportedMessageType) else 'invalid'
+        MESSAGES.inc(message_type=message_type, ack_code='none')
+        raise self.exception
+
+class _EncodedResponse(bytes):
+    # MLLPRequestHandler.handle encodes replies itself; this one already is
+    def encode(self, encoding='utf-8', errors='strict'):
+        return bytes(self)
+
+class BytesMLLPRequestHandler(MLLPRequestHandler):
+    """MLLPRequestHandler that also sends replies built as bytes by the ACK serializer."""
+    def _route_message(self, msg):
+        response = super()._route_message(msg)
+        return _EncodedResponse(response) if isinstance(response, bytes) else response
+
+class InheritedSocketMLLPServer(MLLPServer):
+    """MLLPServer accepting on a listening socket it was handed (app.py's or a --workers one) instead of binding one."""
+    def __init__(self, sock, handlers, timeout=10, request_handler_class=BytesMLLPRequestHandler):
+        self.host, self.port = sock.getsockname()[:2]
+        self.handlers = handlers
+        self.timeout = timeout
+        ThreadingTCPServer.__init__(self, (self.host, self.port), request_handler_class, bind_and_activate=False)
+        self.socket.close()
+        self.socket = sock
+
+def _in_thread(function):
+    # Signal handlers run on the main thread, which is busy serving
+    return lambda *_: threading.Thread(target=function, daemon=True).start()
+
+def advance_clock(seconds=None):
+    # POST /clock/advance?seconds=N on the metrics port, without seconds everything pending is passed
+    passed = response_scheduler.advance(None if seconds is None else float(seconds))
+    return f"Passed {passed} responses"
+
+def refuse_overloaded(message):
+    # asyncio engine: every handler thread is busy, so the AR is built on the event loop instead of queueing
+    try:
+        message_type = get_message_type(message)
+    except Exception:
+        message_type = 'invalid'
+    if message_type not in ('ORM^O01', 'ADT^A04', 'invalid'):
+        message_type = 'unsupported'
+    e = Overloaded('in_flight', f"{MAX_IN_FLIGHT} messages already being handled")
+    REJECTED.inc(message_type=message_type, reason=e.reason)
+    MESSAGES.inc(message_type=message_type, ack_code='AR')
+    return create_ack_response(message, 'AR', str(e))
+
+def start_workers(count):
+    # Every worker must see the patients the others registered before they ACKed them: only SQLite is
+    # shared between processes, and writes go to it before the ACK instead of being batched
+    # (each worker's handler threads share a bounded pool of SQLite connections, whichever the engine)
+    if DATASTORE_MODE != 'sqlite':
+        logging.warning("DATASTORE_MODE=%s is not shared between processes, the workers use sqlite", DATASTORE_MODE)
+    create_backend('sqlite', datastore.data_file).close()  # Create (and import data.json into) the database once
+    env = {'DATASTORE_MODE': 'sqlite', 'DATASTORE_FLUSH_MS': '0'}
+    return run_workers(count, [sys.executable, os.path.abspath(__file__)], env, metrics_port=METRICS_PORT)
 
 if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description="IPMS MLLP server mock")
+    arg_parser.add_argument('--workers', type=int, default=SERVER_WORKERS,
+                            help="server processes sharing the port through SO_REUSEPORT (default: SERVER_WORKERS)")
+    args = arg_parser.parse_args()
+    if args.workers > 1:
+        if LISTEN_FD is None:
+            sys.exit(start_workers(args.workers))
+        logging.warning("--workers is not supported under app.py, running a single server")
+
     # Define handlers for each message type expected
     handlers = {
         'ORM^O01': (HL7Handler,),
-        'ADT^A04': (HL7Handler,)   # Register a patient
+        'ADT^A04': (HL7Handler,),   # Register a patient
+        'ERR': (RejectedMessageHandler,),
     }
 
-    # Set up and start the MLLP server
-    logging.info("Starting MLLP server on %s:%s", SERVER_DOMAIN, SERVER_PORT)
-    server = MLLPServer(SERVER_DOMAIN, SERVER_PORT, handlers)
+    # Stages timed by PROFILE_HOOKS and covered by cProfile captures (PROFILE_AT_START or SIGUSR1)
+    profiler.hook(__name__, 'process_hl7_message')
+    profiler.hook(__name__, 'HL7Handler.reply', counts_messages=True)
+    profiler.hook('handle_adt_a04', 'store_patient')
+    profiler.hook('handle_orm_o01', 'fetch_patient')
+    profiler.hook('handle_adt_a04', 'create_adt_a04_response_message')
+    profiler.hook('handle_orm_o01', 'create_oru_r01_response_message')
+    profiler.hook('mllp_client', 'MLLPClient.send_message')
+    profiler.hook('mllp_client', 'PipelinedMLLPConnection.send')
+    profiler.install_signal_handler()
+    if PROFILE_HOOKS:
+        profiler.enable_timing()
+    if PROFILE_AT_START:
+        profiler.start_capture()
+
+    # Set up and start the MLLP server, on the socket app.py hands over or a SO_REUSEPORT one for --workers
+    sock = listening_socket(SERVER_DOMAIN, SERVER_PORT)
+    logging.info("Starting %s MLLP server on %s:%s", SERVER_ENGINE, SERVER_DOMAIN, SERVER_PORT)
+    if SERVER_ENGINE == 'asyncio':
+        server = AsyncMLLPServer(SERVER_DOMAIN, SERVER_PORT, handlers, sock=sock, drain_timeout=SERVER_DRAIN_TIMEOUT,
+                                 handler_threads=MAX_IN_FLIGHT or None, max_in_flight=MAX_IN_FLIGHT,
+                                 overloaded=refuse_overloaded)
+    elif SERVER_ENGINE == 'threaded':
+        if sock is not None:
+            server = InheritedSocketMLLPServer(sock, handlers)
+        else:
+            server = MLLPServer(SERVER_DOMAIN, SERVER_PORT, handlers, request_handler_class=BytesMLLPRequestHandler)
+    else:
+        raise ValueError(f"Unknown SERVER_ENGINE '{SERVER_ENGINE}', expected 'threaded' or 'asyncio'")
+
+    # Under app.py, connections queue on the shared socket until the server being replaced has stopped
+    notify_ready()
+    if wait_for_takeover():
+        datastore.reopen()  # Picks up the patients the previous server stored
+    adopt_pending_responses(response_scheduler)
+    if RESPONSE_CLOCK == 'manual':
+        action('/clock/advance', advance_clock)
+        if not METRICS_PORT:
+            logging.warning("RESPONSE_CLOCK=manual without METRICS_PORT, responses are never sent")
+    if METRICS_PORT:
+        start_http_server(METRICS_PORT)
+
+    # SIGTERM: stop accepting, finish open connections and hand the pending responses to the next server
+    signal.signal(signal.SIGTERM, _in_thread(server.shutdown))
     server.serve_forever()
+    server.server_close()  # Waits for the connection threads of the threaded engine
+    save_pending_responses(response_scheduler.stop())
+    logging.info("MLLP server stopped")
     